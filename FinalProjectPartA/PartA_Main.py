@@ -1,4 +1,16 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import ProjectPartA
+import server
 
 
 def run_automated_tests():
@@ -25,6 +37,7 @@ def run_automated_tests():
         ("if 3 > 4 == false then 1 else 0", 1),
         ("if 5 > 3 then if 3 < 1 then 1 else 2 else 3", 2),
         ("for 1 to 5 do 3 * 4", 12),  # Will print 3 five times and return 3
+        ("for i = 1 to 4 do i * i", 16),
         (
         "DEFUN factorial(n) : if n == 0 then 1 else n * factorial(n - 1)", "Function 'factorial' defined successfully"),
         ("factorial(5)", 120),
@@ -59,6 +72,455 @@ def run_automated_tests():
 
         print()  # Empty line for better readability between tests
 
+    run_lexer_backend_tests([expression for expression, expected in tests])
+    run_batch_tests(tests)
+    run_engine_tests()
+    run_optimizer_tests()
+    run_vector_tests()
+    run_memo_tests()
+    run_recursion_tests()
+    run_profiler_tests()
+    run_sampler_tests()
+    run_session_tests()
+    run_server_tests()
+    run_program_cache_tests()
+    run_snapshot_tests()
+    run_builtin_tests()
+
+
+def report(title, summary, failures):
+    # Prints a test group's result in the same layout as the tests above
+    print(f"{title}:")
+    print(summary)
+    for failure in failures:
+        print(f"Mismatch: {failure}")
+    print("Test passed" if not failures else "Test failed")
+    print()
+
+
+def token_signature(tok):
+    positions = [None if pos is None else (pos.idx, pos.ln, pos.col, pos.fn)
+                 for pos in (tok.pos_start, tok.pos_end)]
+    return tok.type, tok.value, type(tok.value), positions
+
+
+def lex_signature(lexer_class, text):
+    tokens, error = lexer_class('<stdin>', text).make_tokens()
+    if error:
+        return 'error', error.as_string(), error.pos_start.idx, error.pos_end.idx
+    return [token_signature(tok) for tok in tokens]
+
+
+def run_lexer_backend_tests(expressions):
+    # Both lexer backends must produce the same tokens, values and positions
+    texts = list(expressions) + [
+        "5-3", "3>4", "3 >= 4", "x <y", "a >=\nb", "9>", "1 = 2", "1 == 2",
+        "!x", "1 != 2", "1 $ 2", "foo\tbar", "abc123def", "TRUE and False",
+        "DEFUN f(a, b): a", "x\n", "if x then (lambda y: y)(1) else 0",
+    ]
+    alphabet = "ab1 2-+*/%&|()<>=!:,\tTRUEifDEFUN\n$"
+    rng = random.Random(0)
+    for _ in range(500):
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 30)))
+        # my_Lexer cannot peek past a trailing '-'
+        if not text.endswith('-'):
+            texts.append(text)
+
+    failures = [text for text in texts
+                if lex_signature(ProjectPartA.my_Lexer, text) != lex_signature(ProjectPartA.my_RegexLexer, text)]
+
+    report("Lexer backends", f"{len(texts) - len(failures)}/{len(texts)} inputs produce identical tokens",
+           [repr(text) for text in failures])
+
+
+def run_batch_tests(tests):
+    # The worker processes get every function defined by the tests above
+    results = ProjectPartA.run_many([expression for expression, expected in tests], workers=2)
+    failures = [expression for (expression, expected), (result, error) in zip(tests, results)
+                if not (result == expected or error and str(expected).startswith("Error"))]
+
+    report("Batch evaluation",
+           f"{len(tests) - len(failures)}/{len(tests)} expressions give the same result with run_many", failures)
+
+
+def run_engine_tests():
+    # (statements run in a new session, value of the last one); every engine
+    # must give the expected value
+    programs = [
+        (["DEFUN f(i) : for i = 1 to 3 do (lambda y: i + y)(0)", "f(100)"], 3),
+        (["DEFUN f(i, j) : for i = 1 to 3 do for j = 5 to 6 do (lambda y: i * 10 + j + y)(0)", "f(100, 200)"], 36),
+        (["DEFUN f(i) : (lambda a: a)(for i = 1 to 2 do i) + (lambda y: i + y)(0)", "f(100)"], 102),
+        (["DEFUN f(n) : for i = 1 to 3 do (lambda y: n + i + y)(0)", "f(100)"], 103),
+        (["for i = 1 to 3 do (lambda y: i + y)(0)"], 3),
+    ]
+    failures = []
+
+    for engine in ProjectPartA.ENGINES:
+        for statements, expected in programs:
+            session = ProjectPartA.Session()
+            session.set_loop_output(None)
+            for statement in statements:
+                result, error = session.run('<test>', statement, engine=engine)
+            if error or result != expected:
+                failures.append(f"{engine}: {statements[-1]} gave {error.details if error else result!r}")
+
+    report("Engines", f"{len(programs)} programs give the same results on every engine", failures)
+
+
+def run_optimizer_tests():
+    # (definitions, statement, the optimized tree, or for a definition or a
+    # loop its body, as repr() shows it); every engine must give the same
+    # value and error, at the same position, with and without optimization
+    cases = [
+        ([], "2 + 3 * 4", "T_INT:20"),
+        ([], "-(5 - 8) * 2", "T_INT:6"),
+        ([], "not (3 > 4) AND 2 == 2", "T_BOOLEAN:True"),
+        ([], "true + 0", "T_INT:1"),
+        # Failures are left for runtime
+        ([], "(2 + 3) / 0", "(T_INT:5, T_DIV, T_INT)"),
+        ([], "10 / (4 - 4) + 1", "((T_INT:10, T_DIV, T_INT), T_PLUS, T_INT:1)"),
+        ([], "if 1 > 2 then 5 else 6", "T_INT:6"),
+        ([], "if 2 > 1 then 5 else 1 / 0", "T_INT:5"),
+        ([], "if false then 1", "IfNode(cases=[(T_BOOLEAN, T_INT:1)], else_case=None)"),
+        ([], "for i = 1 to 2 + 1 do i * 1 + 0", "(T_IDENTIFIER:i, T_MUL, T_INT:1)"),
+        ([], "DEFUN f(x) : (x * 3 + 0) * 1", "(T_IDENTIFIER:x, T_MUL, T_INT:3)"),
+        (["DEFUN f(x) : (x * 3 + 0) * 1"], "f(7)", None),
+        ([], "DEFUN g(x) : if x > 4 then x / 1 else if true then 0 - 3 else x",
+         "IfNode(cases=[((T_IDENTIFIER:x, T_GREATERTHAN, T_INT:4), (T_IDENTIFIER:x, T_DIV, T_INT:1))],"
+         " else_case=T_INT:-3)"),
+        (["DEFUN g(x) : if x > 4 then x / 1 else if true then 0 - 3 else x"], "g(5) + g(2)", None),
+        (["DEFUN g(x) : if x > 4 then x / 1 else if true then 0 - 3 else x"], "g(5) / (1 - 1)", None),
+        # x might be a boolean, and true + 0 is 1, so x + 0 stays
+        ([], "DEFUN h(x) : x + 0", "(T_IDENTIFIER:x, T_PLUS, T_INT)"),
+        (["DEFUN h(x) : x + 0"], "h(true)", None),
+        (["DEFUN h(x) : x + 0"], "h(true) * 1", None),
+    ]
+    failures = []
+
+    for definitions, statement, expected_tree in cases:
+        node, error = ProjectPartA.Session().parse('<test>', statement)
+        optimized = repr(getattr(node, 'body_node', node))
+        if expected_tree is not None and optimized != expected_tree:
+            failures.append(f"{statement}: optimized to {optimized}")
+
+        for engine in ProjectPartA.ENGINES:
+            outcomes = []
+            for optimize in (True, False):
+                session = ProjectPartA.Session()
+                session.set_loop_output(None)
+                for definition in definitions:
+                    session.run('<test>', definition, engine=engine, optimize=optimize)
+                result, error = session.run('<test>', statement, engine=engine, optimize=optimize)
+                outcomes.append((result, type(result)) if not error else
+                                (error.as_string(), error.pos_start.idx, error.pos_end.idx))
+            if outcomes[0] != outcomes[1]:
+                failures.append(f"{engine}: {statement} gave {outcomes[0]} optimized, {outcomes[1]} unoptimized")
+
+    report("Optimizer", f"{len(cases)} statements give the same results with and without optimization"
+                        " on every engine", failures)
+
+
+def run_memo_tests():
+    # (statement, its value or None for a definition, {function: (hits, misses)}
+    # from memo_stats() afterwards)
+    chain = {'g': (0, 1), 'h': (0, 1), 'f': (0, 1)}
+    f_hit = {**chain, 'f': (1, 1)}
+    steps = [
+        ("DEFUN g(x) : x + 1", None, {}),
+        ("DEFUN h(x) : g(x) * 3", None, {}),
+        ("DEFUN f(x) : h(x) * 2", None, {}),
+        ("f(3)", 24, chain),
+        ("f(3)", 24, f_hit),
+        # Redefining g clears h, which calls it, and f, which calls h
+        ("DEFUN g(x) : x + 2", None, {}),
+        ("f(3)", 30, chain),
+        # FOR loops print and arguments can be any function: neither is memoized
+        ("DEFUN loud(x) : for i = 1 to 2 do x", None, chain),
+        ("loud(5)", 5, chain),
+        ("DEFUN apply(k, x) : k(x) + 1", None, chain),
+        # apply is not memoized, but the call it makes still finds f(3)
+        ("apply(f, 3)", 31, f_hit),
+        ("DEFUN fib(n) : if n <= 1 then n else fib(n - 1) + fib(n - 2)", None, f_hit),
+        ("fib(30)", 832040, {**f_hit, 'fib': (28, 31)}),
+        # Builtins are pure, and defining a function with their name clears
+        # the memos of their callers too
+        ("DEFUN m(x) : abs(x) + 1", None, {**f_hit, 'fib': (28, 31)}),
+        ("m(-4)", 5, {**f_hit, 'fib': (28, 31), 'm': (0, 1)}),
+        ("DEFUN abs(x) : 0", None, {**f_hit, 'fib': (28, 31)}),
+        ("m(-4)", 1, {**f_hit, 'fib': (28, 31), 'm': (0, 1), 'abs': (0, 1)}),
+    ]
+    failures = []
+
+    for engine in ProjectPartA.ENGINES:
+        session = ProjectPartA.Session()
+        session.set_loop_output(None)
+        for statement, expected, expected_stats in steps:
+            result, error = session.run('<test>', statement, engine=engine)
+            stats = {name: (counts['hits'], counts['misses']) for name, counts in session.memo_stats().items()}
+            if error or (expected is not None and result != expected) or stats != expected_stats:
+                failures.append(f"{engine}: {statement} gave {error.details if error else result!r}, {stats}")
+                break
+
+    report("Memoization", f"{len(steps)} statements memoize and invalidate the same way on every engine", failures)
+
+
+def run_recursion_tests():
+    # Memoization is off so every level is a real call
+    definitions = [
+        "DEFUN factorial(n) : if n == 0 then 1 else n * factorial(n - 1)",
+        "DEFUN count(n) : if n == 0 then 0 else 1 + (lambda x: x + count(n - 1))(0)",
+        "DEFUN down(n) : if n == 0 then 0 else down(n - 1)",
+        "DEFUN fail(n) : if n == 0 then 1 / 0 else 1 + fail(n - 1)",
+    ]
+    cases = [
+        ("factorial(2000)", math.factorial(2000), None),
+        ("count(5000)", 5000, None),
+        ("down(100000)", 0, None),
+        ("fail(3000)", None, "Division by Zero"),
+        ("(" * 1000 + "1" + ")" * 1000, None, "Invalid Syntax"),
+    ]
+    failures = []
+
+    for engine in ProjectPartA.ENGINES:
+        session = ProjectPartA.Session(memo_cache_size=0)
+        for definition in definitions:
+            session.run('<test>', definition, engine=engine)
+        for code, expected, error_name in cases:
+            try:
+                result, error = session.run('<test>', code, engine=engine)
+            except RecursionError:
+                failures.append(f"{engine}: {code[:20]} raised RecursionError")
+                continue
+            if (result, error and error.error_name) != (expected, error_name):
+                failures.append(f"{engine}: {code[:20]} gave {error.details if error else result}")
+
+    # Profiled runs stay on the interpreter, so they only get as deep as
+    # Python's stack allows, but report that as an error
+    session = ProjectPartA.Session(memo_cache_size=0)
+    session.run('<test>', definitions[0])
+    result, error = session.run('<test>', "factorial(2000)", profiler=ProjectPartA.Profiler())
+    if not error or error.details != "Maximum recursion depth exceeded":
+        failures.append(f"profiled factorial(2000) gave {error.details if error else result}")
+
+    report("Deep recursion", f"{len(cases)} deeply recursive calls run on every engine", failures)
+
+
+def run_profiler_tests():
+    # fib(10) makes 177 calls, each visiting one IfNode and one call node; a
+    # second run with the same Profiler adds to the counts and hits the parse
+    # cache. With memoization on, only 11 calls reach the body.
+    failures = []
+
+    for memo_cache_size, calls, memo in ((0, 177, {}), (1024, 11, {'fib': {'hits': 8, 'misses': 11}})):
+        session = ProjectPartA.Session(memo_cache_size=memo_cache_size)
+        session.run('<test>', "DEFUN fib(n) : if n < 2 then n else fib(n - 1) + fib(n - 2)")
+        profiler = ProjectPartA.Profiler()
+        result, error = session.run('<test>', "fib(10)", profiler=profiler)
+        report_data = profiler.report()
+
+        fib_stats = report_data['functions'].get('fib', {})
+        nodes = report_data['nodes']
+        got = (result, fib_stats.get('calls'), nodes.get('IfNode'), report_data['caches']['memo'])
+        if error or got != (55, calls, calls, memo):
+            failures.append(f"memo_cache_size={memo_cache_size}: got {error.details if error else got}")
+        if not (fib_stats.get('total_time', 0) >= fib_stats.get('self_time', 0) > 0):
+            failures.append(f"memo_cache_size={memo_cache_size}: times {fib_stats}")
+        missing = [name for name in ('FunctionCallNode', 'IfNode', 'BinOpNode', 'IdentifierNode', 'NumberNode')
+                   if not nodes.get(name)]
+        if missing or not report_data['lookups']['count']:
+            failures.append(f"memo_cache_size={memo_cache_size}: no visits counted for {missing or 'lookups'}")
+
+        session.run('<test>', "fib(10)", profiler=profiler)
+        report_data = profiler.report()
+        if memo_cache_size == 0 and report_data['functions']['fib']['calls'] != 2 * calls:
+            failures.append(f"second run: {report_data['functions']['fib']['calls']} calls in total")
+        if report_data['caches']['parse'] != {'hits': 1, 'misses': 1}:
+            failures.append(f"second run: parse cache {report_data['caches']['parse']}")
+
+    report("Profiler", "fib(10) is profiled with and without memoization", failures)
+
+
+def run_sampler_tests(attempts=20):
+    # fib(16) takes a few milliseconds on the fastest engine, so it is run
+    # until the sampler has caught it
+    failures = []
+
+    for engine in ProjectPartA.ENGINES:
+        session = ProjectPartA.Session(memo_cache_size=0)
+        session.run('<test>', "DEFUN fib(n) : if n < 2 then n else fib(n - 1) + fib(n - 2)")
+        with ProjectPartA.SamplingProfiler() as sampler:
+            for _ in range(attempts):
+                result, error = session.run('<test>', "fib(16)", engine=engine)
+                if error or result != 987 or '<program>;fib' in sampler.collapsed():
+                    break
+
+        collapsed = sampler.collapsed()
+        if error or result != 987:
+            failures.append(f"{engine}: fib(16) gave {error.details if error else result}")
+        elif '<program>;fib' not in collapsed:
+            failures.append(f"{engine}: no <program>;fib stack in {sampler.sample_count} samples: {collapsed!r}")
+
+    report("Sampling profiler", "fib(16) is sampled as <program>;fib on every engine", failures)
+
+
+class ListOutput:
+    def __init__(self):
+        self.values = []
+
+    def write(self, value):
+        self.values.append(value)
+
+    def flush(self):
+        pass
+
+
+def run_vector_tests():
+    # (loop, whether it runs as array operations); every loop runs at least
+    # VECTOR_MIN_ITERATIONS times, and the numpy engine has to match the
+    # raising engine in value, error and output either way
+    cases = [
+        ("FOR i = 1 TO 100 DO i * i - 3 * i", True),
+        ("FOR i = 0 TO 99 STEP 3 DO -i + 7", True),
+        ("FOR i = -40 TO 40 DO i % 7 + i / 7", True),
+        ("FOR i = 1 TO 40 DO not (i % 2)", True),
+        ("FOR i = 1 TO 40 DO (i % 2 == 0) OR (i > 30)", True),
+        ("FOR i = 0 TO 64 DO if i % 3 == 0 then i / 3 else if i % 3 == 1 then -i else i * 2", True),
+        ("FOR i = 0 TO 40 DO if i == 0 then 0 else 1000 / i", True),
+        ("FOR i = 1 TO 40 DO if i > 100 then true else i", True),
+        # Branches of different kinds print differently, so they run the scalar way
+        ("FOR i = 1 TO 40 DO if i > 20 then i > 30 else i", False),
+        ("FOR i = 1 TO 40 DO i > 10 AND i", False),
+        ("FOR i = 1 TO 40 DO if i < 35 then i", False),
+        # Division by zero in the middle of the range fails after 19 iterations
+        ("FOR i = 1 TO 40 DO 100 / (i - 20)", False),
+        # Values up to 2**62 stay on int64, anything beyond runs on Python ints
+        ("FOR i = 1 TO 40 DO i * 100000000000000000", True),
+        ("FOR i = 1 TO 40 DO i * 200000000000000000", False),
+        ("FOR i = 4611686018427387000 TO 4611686018427387040 DO i - 1", True),
+        ("FOR i = 4611686018427387000 TO 4611686018427387040 DO i + 1000", False),
+        ("FOR i = 4611686018427387900 TO 4611686018427387940 DO i / 2", False),
+        ("FOR i = 1 TO 40 DO -4611686018427387903 + i", False),
+        ("FOR i = 1 TO 2 DO FOR j = 1 TO 40 DO i * j", None),
+    ]
+    failures = []
+
+    for text, vectorized in cases:
+        outcomes = []
+        for engine in ('raising', 'numpy'):
+            session = ProjectPartA.Session()
+            output = ListOutput()
+            session.set_loop_output(output)
+            result, error = session.run('<test>', text, engine=engine)
+            outcomes.append((result, error.as_string() if error else None, output.values))
+        if outcomes[0] != outcomes[1]:
+            failures.append(f"{text}: raising gave {outcomes[0]}, numpy gave {outcomes[1]}")
+
+        if ProjectPartA.np is not None and vectorized is not None and loop_vectorizes(text) != vectorized:
+            failures.append(f"{text}: expected it {'' if vectorized else 'not '}to run as array operations")
+
+    summary = f"{len(cases)} loops of 32 or more iterations on the numpy and raising engines"
+    if ProjectPartA.np is None:
+        summary += " (NumPy is not installed, so every loop ran the scalar way)"
+    report("Vectorized loops", summary, failures)
+
+
+def loop_vectorizes(text):
+    session = ProjectPartA.Session()
+    node, error = session.parse('<test>', text)
+    bounds = ProjectPartA.RaisingInterpreter(session.symbol_table).visit_loop_bounds(node)
+    try:
+        ProjectPartA.vectorize_loop(node, *bounds, session.symbol_table)
+    except ProjectPartA.CannotVectorize:
+        return False
+    return True
+
+
+def run_session_tests(session_count=32, rounds=20):
+    # Every session defines the same names with its own constants and runs on
+    # its own engine; switching threads often makes any shared state show up.
+    def run_session(index):
+        session = ProjectPartA.Session()
+        output = ListOutput()
+        session.set_loop_output(output)
+        engine = ProjectPartA.ENGINES[index % len(ProjectPartA.ENGINES)]
+        errors = []
+        for n in range(rounds):
+            statements = [
+                (f"DEFUN scale(x) : x * {index} + {n}", None),
+                ("DEFUN total(n) : if n == 0 then 0 else scale(n) + total(n - 1)", None),
+                ("total(10)", 55 * index + 10 * n),
+                (f"FOR i = 1 TO 3 DO i * {index}", 3 * index),
+            ]
+            for text, expected in statements:
+                result, error = session.run('<session>', text, engine=engine)
+                if error or (expected is not None and result != expected):
+                    errors.append(f"session {index} ({engine}): {text} gave {error.as_string() if error else result}")
+        if output.values != [index, 2 * index, 3 * index] * rounds:
+            errors.append(f"session {index} ({engine}): wrong loop output")
+        return errors
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            errors = [error for session_errors in executor.map(run_session, range(session_count))
+                      for error in session_errors]
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    report("Concurrent sessions", f"{session_count} sessions evaluated {session_count * rounds * 4} statements"
+                                  " from 8 threads", errors[:10])
+
+
+def run_server_tests():
+    async def exchange(reader, writer, lines):
+        writer.write(b''.join(line.encode() + b'\n' for line in lines))
+        await writer.drain()
+        return [json.loads(await reader.readline()) for line in lines]
+
+    async def run_clients():
+        evaluation_server = server.EvaluationServer(workers=2, timeout=1.0)
+        port = (await evaluation_server.start(port=0)).sockets[0].getsockname()[1]
+        connections = []
+        try:
+            connections = [await asyncio.open_connection('127.0.0.1', port) for _ in range(2)]
+            # Both connections define f; requests are pipelined. The endless
+            # loop times out, and request 7 only gets a response once the
+            # loop has been cancelled.
+            return await asyncio.wait_for(asyncio.gather(*(exchange(*connection, [
+                json.dumps({'id': 1, 'code': f"DEFUN f(x) : x * {index + 2}"}),
+                json.dumps({'id': 2, 'code': "f(10)", 'engine': 'vm'}),
+                json.dumps({'id': 3, 'code': "f(10) / 0"}),
+                "not json",
+                json.dumps({'id': 5, 'code': "f(1) + f(2)"}),
+                json.dumps({'id': 6, 'code': "FOR 1 TO 2 STEP 0 DO f(1)", 'engine': ProjectPartA.ENGINES[index]}),
+                json.dumps({'id': 7, 'code': "f(1)"}),
+            ]) for index, connection in enumerate(connections))), 30)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            for reader, writer in connections:
+                writer.close()
+                await writer.wait_closed()
+            await evaluation_server.close()
+
+    failures = []
+    all_responses = asyncio.run(run_clients())
+    if all_responses is None:
+        failures.append("no response within 30s")
+    for index, responses in enumerate(all_responses or []):
+        scale = index + 2
+        got = [(response['id'], response['result'], (response['error'] or '').split(':')[0])
+               for response in responses]
+        expected = [(1, "Function 'f' defined successfully", ''), (2, 10 * scale, ''),
+                    (3, None, 'Division by Zero'), (None, None, 'Request is not valid JSON'), (5, 3 * scale, ''),
+                    (6, None, 'Timeout'), (7, scale, '')]
+        if got != expected:
+            failures.append(f"connection {index}: {got}")
+
+    report("Evaluation server", "2 connections with their own definitions, 7 pipelined requests each,"
+                                " one of them timing out", failures)
+
 
 def interactive_mode():
     while True:
@@ -76,7 +538,173 @@ def interactive_mode():
         print()
 
 
+def run_program_cache_tests():
+    program = ["DEFUN square(x) : x * x", "", "square(7) + 1", "FOR i = 1 TO 3 DO square(i)"]
+    expected = ["Function 'square' defined successfully", 50, 9]
+    failures = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'library.txt')
+        cache_path = path + ProjectPartA.PROGRAM_CACHE_SUFFIX
+        with open(path, 'w') as file:
+            file.write('\n'.join(program))
+
+        # (description, change made before the run, whether the run parses, results)
+        checks = [
+            ("cold start", None, True, expected),
+            ("warm start", None, False, expected),
+            ("corrupt cache", lambda: corrupt_file(cache_path), True, expected),
+            ("rebuilt cache", None, False, expected),
+            ("stale cache", lambda: append_line(path, "square(3)"), True, expected + [9]),
+        ]
+        for description, change, parses, expected_results in checks:
+            if change: change()
+            session = ProjectPartA.Session()
+            session.set_loop_output(None)
+            results = [result for result, error in session.run_file(path, cache=True)]
+            misses = session.parse_cache_stats()['misses']
+            if results != expected_results or (misses > 0) != parses:
+                failures.append(f"{description}: {results}, {misses} statements parsed")
+
+    report("Program cache",
+           f"{len(checks) - len(failures)}/{len(checks)} runs of a cached program give the same results", failures)
+
+
+def run_snapshot_tests():
+    prelude = [
+        "DEFUN fibonacci(n) : if n <= 1 then n else fibonacci(n - 1) + fibonacci(n - 2)",
+        "DEFUN twice(f, x) : f(f(x))",
+        "DEFUN adder(n) : (lambda f: f)(lambda x: x + n)",
+        "DEFUN addtwice(n) : twice(adder(n), 10)",
+    ]
+    calls = ["fibonacci(20)", "addtwice(5)", "twice(lambda y: y * 3, 2)", "undefined(1)"]
+    failures = []
+
+    session = ProjectPartA.Session()
+    for statement in prelude:
+        session.run('<prelude>', statement)
+    expected = [(result, error and error.as_string()) for result, error in
+                (session.run('<test>', call) for call in calls)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'prelude.snapshot')
+        session.save_snapshot(path)
+
+        for engine in ProjectPartA.ENGINES:
+            restored = ProjectPartA.Session.load_snapshot(path)
+            results = [(result, error and error.as_string()) for result, error in
+                       (restored.run('<test>', call, engine=engine) for call in calls)]
+            if results != expected:
+                failures.append(f"{engine}: {results}")
+
+        # Sessions restored from a snapshot are independent of each other
+        restored.run('<test>', "DEFUN fibonacci(n) : 0")
+        if ProjectPartA.Session.load_snapshot(path).run('<test>', "fibonacci(10)")[0] != 55:
+            failures.append("redefining a function changed the snapshot")
+
+        corrupt_file(path)
+        try:
+            ProjectPartA.Session.load_snapshot(path)
+            failures.append("a corrupted snapshot was loaded")
+        except ValueError:
+            pass
+
+    report("Session snapshots", f"{len(calls)} calls give the same results after restoring a snapshot on every engine",
+           failures)
+
+
+def run_builtin_tests():
+    cases = [
+        ("abs(-7)", 7, None),
+        ("min(4, -2, 9)", -2, None),
+        ("max(4, -2, 9)", 9, None),
+        ("pow(3, 200, 1000007)", pow(3, 200, 1000007), None),
+        ("pow(3, -1, 7)", 5, None),
+        ("pow(2, 64)", 2 ** 64, None),
+        ("gcd(84, 36, 120)", 12, None),
+        ("sqrt(99)", 9, None),
+        ("abs(1, 2)", None, "1 arguments expected, got 2"),
+        ("max()", None, "at least 1 arguments expected, got 0"),
+        ("pow(2, -1)", None, "pow(): negative exponent without a modulus"),
+        ("sqrt(-4)", None, "sqrt(): square root of a negative number"),
+        # Too big to compute: fails right away instead of running for hours
+        ("pow(10, 999999999)", None, "pow(): result would have more than 1048576 bits"),
+        ("pow(-1, 999999999)", -1, None),
+        ("DEFUN abs(x) : x * 10", None, None),
+        ("abs(-7)", -70, None),
+    ]
+    failures = []
+
+    for engine in ProjectPartA.ENGINES:
+        session = ProjectPartA.Session()
+        for code, expected, message in cases:
+            start = time.perf_counter()
+            result, error = session.run('<test>', code, engine=engine)
+            elapsed = time.perf_counter() - start
+            if code.startswith('DEFUN'):
+                continue
+            details = error.details if error else None
+            if (result, details) != (expected, message):
+                failures.append(f"{engine}: {code} gave {result!r}, {details!r}")
+            if elapsed > 1:
+                failures.append(f"{engine}: {code} took {elapsed:.1f}s")
+
+    report("Builtin functions", f"{len(cases)} statements give the same results on every engine", failures)
+
+
+def corrupt_file(path):
+    with open(path, 'r+b') as file:
+        file.seek(os.path.getsize(path) // 2)
+        byte = file.read(1)
+        file.seek(-1, os.SEEK_CUR)
+        file.write(bytes([byte[0] ^ 0xff]))
+
+
+def append_line(path, line):
+    with open(path, 'a') as file:
+        file.write('\n' + line)
+
+
+def run_script(path, engine, lexer, cache=False):
+    # Prints the result of each statement as it runs; stops at the first error
+    for result, error in ProjectPartA.run_file(path, engine=engine, lexer=lexer, cache=cache):
+        if error:
+            print(error.as_string())
+            return 1
+        print(result)
+    return 0
+
+
+def run_sampled_script(path, engine, lexer, cache, flamegraph_path, speedscope_path):
+    with ProjectPartA.SamplingProfiler() as sampler:
+        status = run_script(path, engine, lexer, cache)
+
+    if flamegraph_path:
+        with open(flamegraph_path, 'w') as file:
+            file.write(sampler.collapsed())
+    if speedscope_path:
+        with open(speedscope_path, 'w') as file:
+            json.dump(sampler.speedscope(name=path), file)
+    print(f"{sampler.sample_count} samples written", file=sys.stderr)
+    return status
+
+
 def main():
+    arg_parser = argparse.ArgumentParser(description="Run a script, or start the menu when no script is given.")
+    arg_parser.add_argument('script', nargs='?', help="file with one statement per line")
+    arg_parser.add_argument('--engine', default='interpreter', choices=ProjectPartA.ENGINES)
+    arg_parser.add_argument('--lexer', default='reference', choices=tuple(ProjectPartA.LEXERS))
+    arg_parser.add_argument('--cache', action='store_true', help="keep the parsed script in a cache file next to it")
+    arg_parser.add_argument('--flamegraph', metavar='PATH', help="sample the script and write collapsed stacks")
+    arg_parser.add_argument('--speedscope', metavar='PATH', help="sample the script and write a speedscope profile")
+    args = arg_parser.parse_args()
+
+    if args.script and (args.flamegraph or args.speedscope):
+        sys.exit(run_sampled_script(args.script, args.engine, args.lexer, args.cache, args.flamegraph,
+                                    args.speedscope))
+    if args.script:
+        sys.exit(run_script(args.script, args.engine, args.lexer, args.cache))
+
     while True:
         print("\nChoose an option:")
         print("1. Run automated tests")
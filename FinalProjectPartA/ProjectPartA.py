@@ -1,3 +1,25 @@
+import hashlib
+import io
+import math
+import multiprocessing
+import operator
+import os
+import pickle
+import re
+import sys
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from functools import partial
+
+try:
+    import numpy as np
+except ImportError:
+    # Optional: without NumPy the 'numpy' engine runs every loop as scalar code
+    np = None
+
 #######################################
 # CONSTANTS
 #######################################
@@ -63,30 +85,117 @@ class RTError(Error):
         return 'Traceback (most recent call last):\n' + result
 
 
+class RTException(Exception):
+    """Carries an Error out of engines that propagate failures by raising."""
+
+    def __init__(self, error):
+        super().__init__(error.details)
+        self.error = error
+
+
+class LexerException(Exception):
+    """Carries a lexing Error out of a token generator."""
+
+    def __init__(self, error):
+        super().__init__(error.details)
+        self.error = error
+
+
+class EvaluationCancelled(Exception):
+    """Raised by the engines, at the next function call or loop iteration,
+    when the statement they are running was cancelled with Session.cancel()."""
+
+
 #######################################
 # POSITION
 #######################################
 
+class Source:
+    """The file name and text shared by every position into it."""
+
+    __slots__ = ('fn', 'text', 'first_line', 'line_starts')
+
+    def __init__(self, fn, text, first_line=0):
+        self.fn = fn
+        self.text = text
+        # Line number of the text's first line, for statements taken from a file
+        self.first_line = first_line
+        self.line_starts = None
+
+    def line_col(self, idx):
+        # Line numbers are only needed to render an error, so the index of
+        # line starts is built the first time one is asked for.
+        if self.line_starts is None:
+            self.line_starts = [0] + [match.end() for match in re.finditer('\n', self.text)]
+        ln = max(bisect_right(self.line_starts, idx) - 1, 0)
+        return self.first_line + ln, idx - self.line_starts[ln]
+
+
 class Position:
-    def __init__(self, idx, ln, col, fn, ftxt):
+    __slots__ = ('idx', 'source')
+
+    def __init__(self, idx, source):
         self.idx = idx
-        self.ln = ln
-        self.col = col
-        self.fn = fn
-        self.ftxt = ftxt
+        self.source = source
 
-    def advance(self, current_char=None):
-        self.idx += 1
-        self.col += 1
+    @property
+    def ln(self):
+        return self.source.line_col(self.idx)[0]
+
+    @property
+    def col(self):
+        return self.source.line_col(self.idx)[1]
 
-        if current_char == '\n':
-            self.ln += 1
-            self.col = 0
+    @property
+    def fn(self):
+        return self.source.fn
 
+    @property
+    def ftxt(self):
+        return self.source.text
+
+    def advance(self):
+        self.idx += 1
         return self
 
     def copy(self):
-        return Position(self.idx, self.ln, self.col, self.fn, self.ftxt)
+        return Position(self.idx, self.source)
+
+
+class SourceRange:
+    """Base for tokens and nodes, which keep their extent as offsets into a
+    shared Source and only build Position objects when they are asked for."""
+
+    __slots__ = ('source', 'start', 'end')
+
+    @property
+    def pos_start(self):
+        return None if self.start is None else Position(self.start, self.source)
+
+    @pos_start.setter
+    def pos_start(self, pos):
+        if pos is None:
+            self.start = None
+        else:
+            self.start = pos.idx
+            self.source = pos.source
+
+    @property
+    def pos_end(self):
+        return None if self.end is None else Position(self.end, self.source)
+
+    @pos_end.setter
+    def pos_end(self, pos):
+        if pos is None:
+            self.end = None
+        else:
+            self.end = pos.idx
+            self.source = pos.source
+
+    def set_range(self, first, last):
+        self.source = first.source or last.source
+        self.start = first.start
+        self.end = last.end
 
 
 ##############################################
@@ -127,24 +236,21 @@ T_LAMBDA = 'T_LAMBDA'
 
 
 
-class my_Token:
+class my_Token(SourceRange):
+    __slots__ = ('type', 'value')
+
     def __init__(self, type_, value=None, pos_start=None, pos_end=None):
         self.type = type_
         self.value = value
+        self.source = self.start = self.end = None
 
         if pos_start:
-            self.pos_start = pos_start.copy()
-        else:
-            self.pos_start = None
-
-        if pos_end:
-            self.pos_end = pos_end.copy()
-        else:
-            self.pos_end = None
-
-        if pos_start:
-            self.pos_end = pos_start.copy()
-            self.pos_end.advance()
+            self.source = pos_start.source
+            self.start = pos_start.idx
+            self.end = pos_start.idx + 1
+        elif pos_end:
+            self.source = pos_end.source
+            self.end = pos_end.idx
 
     def matches(self, type_, value=None):
         return self.type == type_ and (self.value == value or value is None)
@@ -159,81 +265,85 @@ class my_Token:
 ##############################################
 
 class my_Lexer:
-    def __init__(self, fn, text):
+    def __init__(self, fn, text, first_line=0):
         self.fn = fn
         self.text = text
-        self.pos = Position(-1, 0, -1, fn, text)
+        self.pos = Position(-1, Source(fn, text, first_line))
         self.current_char = None
         self.advance()
 
     def advance(self):  # the next char in the token
-        self.pos.advance(self.current_char)
+        self.pos.advance()
         self.current_char = self.text[self.pos.idx] if self.pos.idx < len(self.text) else None
 
     def make_tokens(self):
-        tokens = []
-
+        try:
+            return list(self.generate_tokens()), None
+        except LexerException as exception:
+            return [], exception.error
+
+    def generate_tokens(self):
+        # Tokens are produced one at a time, so the parser can consume them
+        # while the rest of the text is still unread.
         while self.current_char != None:
             if self.current_char in ' \t':
                 self.advance()
             elif self.current_char in DIGITS:
-                tokens.append(self.make_number())
+                yield self.make_number()
             elif self.current_char == '-' and self.peek_next_char() in DIGITS:
-                tokens.append(self.make_negative_number())
+                yield self.make_negative_number()
             elif self.current_char in LETTERS:
-                tokens.append(self.make_identifier())
+                yield self.make_identifier()
             elif self.current_char == '+':
-                tokens.append(my_Token(T_PLUS))
+                yield my_Token(T_PLUS)
                 self.advance()
             elif self.current_char == '-':
-                tokens.append(my_Token(T_SUB))
+                yield my_Token(T_SUB)
                 self.advance()
             elif self.current_char == '*':
-                tokens.append(my_Token(T_MUL))
+                yield my_Token(T_MUL)
                 self.advance()
             elif self.current_char == '/':
-                tokens.append(my_Token(T_DIV))
+                yield my_Token(T_DIV)
                 self.advance()
             elif self.current_char == '%':
-                tokens.append(my_Token(T_MODULO))
+                yield my_Token(T_MODULO)
                 self.advance()
             elif self.current_char == '&':
-                tokens.append(my_Token(T_AND))
+                yield my_Token(T_AND)
                 self.advance()
             elif self.current_char == '|':
-                tokens.append(my_Token(T_OR))
+                yield my_Token(T_OR)
                 self.advance()
             elif self.current_char == '!':
                 token, error = self.make_not_equals()
-                if error: return [], error
-                tokens.append(token)
+                if error: raise LexerException(error)
+                yield token
             elif self.current_char == '=':
-                tokens.append(self.make_equals())
+                yield self.make_equals()
             elif self.current_char == '>':
-                tokens.append(self.make_greater_than())
+                yield self.make_greater_than()
                 self.advance()
             elif self.current_char == '<':
-                tokens.append(self.make_less_than())
+                yield self.make_less_than()
                 self.advance()
             elif self.current_char == '(':
-                tokens.append(my_Token(T_LPAREN))
+                yield my_Token(T_LPAREN)
                 self.advance()
             elif self.current_char == ')':
-                tokens.append(my_Token(T_RPAREN))
+                yield my_Token(T_RPAREN)
                 self.advance()
             elif self.current_char == ':':
-                tokens.append(my_Token(T_COLON, pos_start=self.pos))
+                yield my_Token(T_COLON, pos_start=self.pos)
                 self.advance()
             elif self.current_char == ',':
-                tokens.append(my_Token(T_COMMA, pos_start=self.pos))
+                yield my_Token(T_COMMA, pos_start=self.pos)
                 self.advance()
             else:
                 pos_start = self.pos.copy()
                 char = self.current_char
                 self.advance()
-                return [], IllegalCharError(pos_start, self.pos, "'" + char + "'")
-
-        return tokens, None
+                raise LexerException(IllegalCharError(pos_start, self.pos, "'" + char + "'"))
 
     def make_number(self):
         num_str = ''
@@ -357,67 +467,271 @@ class my_Lexer:
         return word.lower()
 
 
+##############################################
+# FAST LEXER
+##############################################
+
+KEYWORDS = {
+    'if': (T_IF, None),
+    'then': (T_THEN, None),
+    'else': (T_ELSE, None),
+    'elseif': (T_ELSEIF, None),
+    'for': (T_FOR, None),
+    'to': (T_TO, None),
+    'step': (T_STEP, None),
+    'do': (T_DO, None),
+    'and': (T_AND, None),
+    'or': (T_OR, None),
+    'not': (T_NOT, None),
+    'defun': (T_DEFUN, None),
+    'lambda': (T_LAMBDA, None),
+    'true': (T_BOOLEAN, True),
+    'false': (T_BOOLEAN, False),
+}
+
+# Operators that my_Lexer emits without a position
+UNPOSITIONED_TOKENS = {
+    '+': T_PLUS,
+    '-': T_SUB,
+    '*': T_MUL,
+    '/': T_DIV,
+    '%': T_MODULO,
+    '&': T_AND,
+    '|': T_OR,
+    '(': T_LPAREN,
+    ')': T_RPAREN,
+}
+
+POSITIONED_TOKENS = {
+    ':': T_COLON,
+    ',': T_COMMA,
+}
+
+# Leading blanks, then one alternative per token class in the order my_Lexer
+# tries them. After a '>' or '<' comparison my_Lexer steps over one more
+# character, so the patterns swallow it too to keep both token streams
+# identical.
+TOKEN_REGEX = re.compile(r'''
+    [ \t]*
+  (?:
+    (?P<INT>-?[0-9]+)
+  | (?P<IDENTIFIER>[A-Za-z]+)
+  | (?P<UNPOSITIONED>[-+*/%&|()])
+  | (?P<POSITIONED>[:,])
+  | (?P<EQUALS>==?)
+  | (?P<NOTEQUAL>!=)
+  | (?P<GREATERTHAN>>=?)[\s\S]?
+  | (?P<LESSTHAN><=?)[\s\S]?
+  | (?P<ILLEGAL>[^ \t])
+  )
+''', re.VERBOSE)
+
+
+class my_RegexLexer:
+    def __init__(self, fn, text, first_line=0):
+        self.fn = fn
+        self.text = text
+        self.source = Source(fn, text, first_line)
+
+    def position(self, idx):
+        return Position(idx, self.source)
+
+    def make_token(self, type_, value, idx):
+        tok = my_Token(type_, value)
+        tok.source = self.source
+        tok.start = idx
+        tok.end = idx + 1
+        return tok
+
+    def make_tokens(self):
+        try:
+            return list(self.generate_tokens()), None
+        except LexerException as exception:
+            return [], exception.error
+
+    def generate_tokens(self):
+        text = self.text
+
+        # Every character starts a match (ILLEGAL catches the rest), so the
+        # matches are contiguous; only trailing blanks are left unmatched.
+        for m in TOKEN_REGEX.finditer(text):
+            kind = m.lastgroup
+            start = m.start(kind)
+
+            if kind == 'IDENTIFIER':
+                id_str = m.group(kind)
+                keyword = KEYWORDS.get(id_str.lower())
+                if keyword:
+                    yield self.make_token(keyword[0], keyword[1], start)
+                else:
+                    yield self.make_token(T_IDENTIFIER, id_str, start)
+            elif kind == 'INT':
+                yield self.make_token(T_INT, int(m.group(kind)), start)
+            elif kind == 'UNPOSITIONED':
+                yield my_Token(UNPOSITIONED_TOKENS[text[start]])
+            elif kind == 'POSITIONED':
+                yield self.make_token(POSITIONED_TOKENS[text[start]], None, start)
+            elif kind == 'EQUALS':
+                yield self.make_token(T_EQEQ, None, start)
+            elif kind == 'NOTEQUAL':
+                yield self.make_token(T_NOTEQUAL, None, start)
+            elif kind == 'GREATERTHAN':
+                tok_type = T_EQGREATERTHAN if m.group(kind) == '>=' else T_GREATERTHAN
+                yield self.make_token(tok_type, None, start)
+            elif kind == 'LESSTHAN':
+                tok_type = T_EQLESSTHAN if m.group(kind) == '<=' else T_LESSTHAN
+                yield self.make_token(tok_type, None, start)
+            else:
+                char = text[start]
+                if char == '!':
+                    raise LexerException(ExpectedCharError(self.position(start), self.position(start + 1), "'=' (after '!')"))
+                raise LexerException(IllegalCharError(self.position(start), self.position(start + 1), "'" + char + "'"))
+
+
+LEXERS = {
+    'reference': my_Lexer,
+    'regex': my_RegexLexer,
+}
+
+
+#######################################
+# OPERATORS
+#######################################
+
+def logical_and(left, right):
+    return left if not left else right
+
+
+def logical_or(left, right):
+    return left if left else right
+
+
+# Named functions rather than lambdas throughout, so that trees holding them
+# can be pickled
+BINARY_OPS = {
+    T_PLUS: operator.add,
+    T_SUB: operator.sub,
+    T_MUL: operator.mul,
+    T_MODULO: operator.mod,
+    T_EQEQ: operator.eq,
+    T_NOTEQUAL: operator.ne,
+    T_GREATERTHAN: operator.gt,
+    T_LESSTHAN: operator.lt,
+    T_EQGREATERTHAN: operator.ge,
+    T_EQLESSTHAN: operator.le,
+    T_AND: logical_and,
+    T_OR: logical_or,
+}
+
+COMPARISON_OPS = (T_EQEQ, T_NOTEQUAL, T_GREATERTHAN, T_LESSTHAN, T_EQGREATERTHAN, T_EQLESSTHAN)
+
+# Handlers for int operands, which are also correct for any other values.
+# Division can go straight to floordiv: a zero divisor raises
+# ZeroDivisionError, which the tree walkers turn into a DivisionByZeroError.
+INT_BINARY_OPS = {**BINARY_OPS, T_DIV: operator.floordiv}
+
+# Both operands bools: AND and OR give the same bool as & and |, without a
+# Python-level call
+BOOL_BINARY_OPS = {**INT_BINARY_OPS, T_AND: operator.and_, T_OR: operator.or_}
+
+
+def is_bool_valued(node):
+    # Comparisons and NOT always yield a bool, and the optimizer only ever
+    # replaces them with a constant of the same value.
+    if isinstance(node, BooleanNode):
+        return True
+    if isinstance(node, BinOpNode):
+        if node.op_tok.type in (T_AND, T_OR):
+            return is_bool_valued(node.left_node) and is_bool_valued(node.right_node)
+        return node.op_tok.type in COMPARISON_OPS
+    if isinstance(node, UnaryOpNode):
+        return node.op_tok.type == T_NOT
+    return False
+
+
+def binary_op_function(left_node, op_tok, right_node):
+    # Picked from the operand types known at parse time, so evaluating the
+    # node is a single call with no type checks
+    if is_bool_valued(left_node) and is_bool_valued(right_node):
+        return BOOL_BINARY_OPS[op_tok.type]
+    return INT_BINARY_OPS[op_tok.type]
+
+
+def division_by_zero_error(node):
+    pos_start = node.op_tok.pos_start if node.op_tok.pos_start else node.left_node.pos_start
+    pos_end = node.op_tok.pos_end if node.op_tok.pos_end else node.right_node.pos_end
+    return DivisionByZeroError(pos_start, pos_end)
+
+
 #######################################
 # NODES
 #######################################
 
-class NumberNode:
+class NumberNode(SourceRange):
+    __slots__ = ('tok',)
+
     def __init__(self, tok):
         self.tok = tok
 
-        self.pos_start = self.tok.pos_start
-        self.pos_end = self.tok.pos_end
+        self.set_range(tok, tok)
 
     def __repr__(self):
         return f'{self.tok}'
 
 
-class BooleanNode:
+class BooleanNode(SourceRange):
+    __slots__ = ('tok',)
+
     def __init__(self, tok):
         self.tok = tok
-        self.pos_start = self.tok.pos_start
-        self.pos_end = self.tok.pos_end
+        self.set_range(tok, tok)
 
     def __repr__(self):
         return f'{self.tok}'
 
 
-class BinOpNode:
+class BinOpNode(SourceRange):
+    __slots__ = ('left_node', 'op_tok', 'right_node', 'op_func')
+
     def __init__(self, left_node, op_tok, right_node):
         self.left_node = left_node
         self.op_tok = op_tok
         self.right_node = right_node
+        self.op_func = binary_op_function(left_node, op_tok, right_node)
 
-        self.pos_start = self.left_node.pos_start
-        self.pos_end = self.right_node.pos_end
+        self.set_range(left_node, right_node)
 
     def __repr__(self):
         return f'({self.left_node}, {self.op_tok}, {self.right_node})'
 
 
-class UnaryOpNode:
+class UnaryOpNode(SourceRange):
+    __slots__ = ('op_tok', 'node')
+
     def __init__(self, op_tok, node):
         self.op_tok = op_tok
         self.node = node
-        self.pos_start = self.op_tok.pos_start
-        self.pos_end = node.pos_end
+        self.set_range(op_tok, node)
 
     def __repr__(self):
         return f'({self.op_tok}, {self.node})'
 
-class IfNode:
+class IfNode(SourceRange):
+    __slots__ = ('cases', 'else_case')
+
     def __init__(self, cases, else_case):
         self.cases = cases
         self.else_case = else_case
 
-        self.pos_start = self.cases[0][0].pos_start
-        self.pos_end = (self.else_case or self.cases[-1][1]).pos_end
+        self.set_range(self.cases[0][0], self.else_case or self.cases[-1][1])
 
     def __repr__(self):
         return f'IfNode(cases={self.cases}, else_case={self.else_case})'
 
 
-class ForNode:
+class ForNode(SourceRange):
+    __slots__ = ('var_name_tok', 'start_value_node', 'end_value_node', 'step_value_node', 'body_node')
+
     def __init__(self, var_name_tok, start_value_node, end_value_node, step_value_node, body_node):
         self.var_name_tok = var_name_tok
         self.start_value_node = start_value_node
@@ -425,54 +739,76 @@ class ForNode:
         self.step_value_node = step_value_node
         self.body_node = body_node
 
+        self.set_range(var_name_tok or start_value_node, body_node)
+
     def __repr__(self):
         return f'ForNode(var_name={self.var_name_tok}, start={self.start_value_node}, end={self.end_value_node}, step={self.step_value_node}, body={self.body_node})'
 
-class FunctionDefNode:
+class FunctionDefNode(SourceRange):
+    __slots__ = ('name_tok', 'arg_name_toks', 'body_node')
+
     def __init__(self, name_tok, arg_name_toks, body_node):
         self.name_tok = name_tok
         self.arg_name_toks = arg_name_toks
         self.body_node = body_node
 
-        self.pos_start = self.name_tok.pos_start
-        self.pos_end = self.body_node.pos_end
-class FunctionCallNode:
+        self.set_range(name_tok, body_node)
+class FunctionCallNode(SourceRange):
+    __slots__ = ('name_tok', 'arg_nodes', 'is_tail')
+
     def __init__(self, name_tok, arg_nodes):
         self.name_tok = name_tok
         self.arg_nodes = arg_nodes
+        self.is_tail = False
+
+        self.set_range(name_tok, self.arg_nodes[-1] if self.arg_nodes else name_tok)
+class ListNode(SourceRange):
+    __slots__ = ('element_nodes',)
 
-        self.pos_start = self.name_tok.pos_start
-        self.pos_end = (self.arg_nodes[-1].pos_end if self.arg_nodes
-                        else self.name_tok.pos_end)
-class ListNode:
     def __init__(self, element_nodes, pos_start, pos_end):
         self.element_nodes = element_nodes
 
+        self.source = None
         self.pos_start = pos_start
         self.pos_end = pos_end
 
-class IdentifierNode:
+class IdentifierNode(SourceRange):
+    __slots__ = ('tok',)
+
     def __init__(self, tok):
         self.tok = tok
-        self.pos_start = self.tok.pos_start
-        self.pos_end = self.tok.pos_end
+        self.set_range(tok, tok)
 
     def __repr__(self):
         return f'{self.tok}'
 
-class LambdaNode:
+class LambdaNode(SourceRange):
+    __slots__ = ('arg_name_toks', 'body_node')
+
     def __init__(self, arg_name_toks, body_node):
         self.arg_name_toks = arg_name_toks
         self.body_node = body_node
 
-        self.pos_start = self.arg_name_toks[0].pos_start if self.arg_name_toks else self.body_node.pos_start
-        self.pos_end = self.body_node.pos_end
+        self.set_range(self.arg_name_toks[0] if self.arg_name_toks else body_node, body_node)
+
+def mark_tail_calls(body_node):
+    # A call is in tail position when its value is returned straight out of
+    # the function body, either directly or through the branches of an IF.
+    if isinstance(body_node, FunctionCallNode):
+        body_node.is_tail = True
+    elif isinstance(body_node, IfNode):
+        for condition, expr in body_node.cases:
+            mark_tail_calls(expr)
+        if body_node.else_case:
+            mark_tail_calls(body_node.else_case)
 
 #######################################
 # PARSE RESULT
 #######################################
 
 class ParseResult:
+    __slots__ = ('error', 'node', 'advance_count', 'to_reverse_count')
+
     def __init__(self):
         self.error = None
         self.node = None
@@ -508,7 +844,10 @@ class ParseResult:
 #######################################
 class Parser:
     def __init__(self, tokens):
-        self.tokens = tokens
+        # tokens may be a list or a lazy stream such as a lexer's
+        # generate_tokens(); only the tokens in lookahead are held.
+        self.tokens = iter(tokens)
+        self.lookahead = deque()
         self.token_idx = -1
         self.advance()
 
@@ -518,10 +857,16 @@ class Parser:
         return self.current_token
 
     def update_current_token(self):
-        if self.token_idx >= 0 and self.token_idx < len(self.tokens):
-            self.current_token = self.tokens[self.token_idx]
+        if self.lookahead:
+            self.current_token = self.lookahead.popleft()
         else:
-            self.current_token = None
+            self.current_token = next(self.tokens, None)
+
+    def peek(self, offset=1):
+        # The token offset places after the current one, or None past the end
+        while len(self.lookahead) < offset:
+            self.lookahead.append(next(self.tokens, None))
+        return self.lookahead[offset - 1]
 
     def parse(self):
         res = ParseResult()
@@ -654,6 +999,7 @@ class Parser:
 
         body = res.register(self.expr())
         if res.error: return res
+        mark_tail_calls(body)
 
         return res.success(FunctionDefNode(
             func_name,
@@ -829,6 +1175,13 @@ class Parser:
                 IllegalCharError(self.current_token.pos_start, self.current_token.pos_end, "Expected 'for'"))
         self.advance()
 
+        # FOR name = start TO end ... binds the loop variable ('=' lexes as '==')
+        var_name_tok = None
+        if self.current_token.type == T_IDENTIFIER and self.peek() and self.peek().type == T_EQEQ:
+            var_name_tok = self.current_token
+            self.advance()
+            self.advance()
+
         start_value = res.register(self.expression())
         if res.error: return res
 
@@ -855,7 +1208,7 @@ class Parser:
         body = res.register(self.expression())
         if res.error: return res
 
-        return res.success(ForNode(None, start_value, end_value, step_value, body))
+        return res.success(ForNode(var_name_tok, start_value, end_value, step_value, body))
 
     def function_call(self, func_name_or_lambda):
         res = ParseResult()
@@ -943,55 +1296,653 @@ class Parser:
 
         body = res.register(self.expr())
         if res.error: return res
+        mark_tail_calls(body)
 
         return res.success(LambdaNode(arg_name_toks, body))
 
+#######################################
+# CACHES
+#######################################
+
+_MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        data = self.data
+        if key in data:
+            data.move_to_end(key)
+            self.hits += 1
+            return data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        data = self.data
+        data[key] = value
+        data.move_to_end(key)
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self.data) > max(maxsize, 0):
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+#######################################
+# OPTIMIZER
+#######################################
+
+ARITHMETIC_OPS = (T_PLUS, T_SUB, T_MUL, T_DIV, T_MODULO)
+
+
+def is_constant(node):
+    return isinstance(node, (NumberNode, BooleanNode))
+
+
+def is_int_valued(node):
+    # Arithmetic always yields an int (true + true == 2), so identities like
+    # x * 1 can be dropped without turning a boolean into an int.
+    if isinstance(node, NumberNode):
+        return True
+    if isinstance(node, BinOpNode):
+        return node.op_tok.type in ARITHMETIC_OPS
+    if isinstance(node, UnaryOpNode):
+        return node.op_tok.type == T_SUB
+    return False
+
+
+def make_constant_node(value, node):
+    # The folded node keeps the source range of the expression it replaces
+    if type(value) is bool:
+        tok = my_Token(T_BOOLEAN, value)
+        constant_node = BooleanNode(tok)
+    elif type(value) is int:
+        tok = my_Token(T_INT, value)
+        constant_node = NumberNode(tok)
+    else:
+        return None
+
+    tok.set_range(node, node)
+    constant_node.set_range(node, node)
+    return constant_node
+
+
+class Optimizer:
+    def optimize(self, node):
+        method_name = f'optimize_{type(node).__name__}'
+        method = getattr(self, method_name, self.no_optimize_method)
+        return method(node)
+
+    def no_optimize_method(self, node):
+        return node
+
+    def optimize_BinOpNode(self, node):
+        node.left_node = self.optimize(node.left_node)
+        node.right_node = self.optimize(node.right_node)
+        left, right = node.left_node, node.right_node
+        op_type = node.op_tok.type
+
+        if is_constant(left) and is_constant(right):
+            left_value, right_value = left.tok.value, right.tok.value
+
+            # Division by zero and any other failure are left for runtime,
+            # so the error and its position are exactly what they were.
+            try:
+                if op_type == T_DIV:
+                    value = None if right_value == 0 else left_value // right_value
+                else:
+                    value = BINARY_OPS[op_type](left_value, right_value)
+            except Exception:
+                value = None
+
+            folded = make_constant_node(value, node)
+            if folded: return folded
+
+        # x + 0, 0 + x, x - 0, x * 1, 1 * x, x / 1
+        if op_type in (T_PLUS, T_SUB, T_MUL, T_DIV):
+            identity = 0 if op_type in (T_PLUS, T_SUB) else 1
+
+            if isinstance(right, NumberNode) and right.tok.value == identity and is_int_valued(left):
+                return left
+            if (op_type in (T_PLUS, T_MUL) and isinstance(left, NumberNode)
+                    and left.tok.value == identity and is_int_valued(right)):
+                return right
+
+        return node
+
+    def optimize_UnaryOpNode(self, node):
+        node.node = self.optimize(node.node)
+
+        if node.op_tok.type == T_PLUS:
+            return node.node
+
+        if is_constant(node.node):
+            value = node.node.tok.value
+            if node.op_tok.type == T_NOT:
+                value = not value
+            elif node.op_tok.type == T_SUB:
+                value = -value
+
+            folded = make_constant_node(value, node)
+            if folded: return folded
+
+        return node
+
+    def optimize_IfNode(self, node):
+        cases = []
+
+        for condition, expr in node.cases:
+            condition = self.optimize(condition)
+            expr = self.optimize(expr)
+
+            if is_constant(condition):
+                if not condition.tok.value:
+                    continue
+                # Always taken: it becomes the ELSE and later cases are dead
+                if not cases: return expr
+                node.cases = cases
+                node.else_case = expr
+                return node
+
+            cases.append((condition, expr))
+
+        else_case = self.optimize(node.else_case) if node.else_case else None
+
+        if not cases:
+            return else_case or node
+        node.cases = cases
+        node.else_case = else_case
+        return node
+
+    def optimize_ForNode(self, node):
+        node.start_value_node = self.optimize(node.start_value_node)
+        node.end_value_node = self.optimize(node.end_value_node)
+        if node.step_value_node:
+            node.step_value_node = self.optimize(node.step_value_node)
+        node.body_node = self.optimize(node.body_node)
+        return node
+
+    def optimize_FunctionDefNode(self, node):
+        node.body_node = self.optimize(node.body_node)
+        mark_tail_calls(node.body_node)
+        return node
+
+    def optimize_LambdaNode(self, node):
+        node.body_node = self.optimize(node.body_node)
+        mark_tail_calls(node.body_node)
+        return node
+
+    def optimize_FunctionCallNode(self, node):
+        if isinstance(node.name_tok, LambdaNode):
+            node.name_tok = self.optimize(node.name_tok)
+        node.arg_nodes = [self.optimize(arg_node) for arg_node in node.arg_nodes]
+        return node
+
+#######################################
+# SYMBOL TABLE
+#######################################
+
+class SymbolTable:
+    __slots__ = ('symbols', 'parent', 'dependents')
+
+    def __init__(self, parent=None, symbols=None):
+        self.symbols = {} if symbols is None else symbols
+        self.parent = parent
+        # Analyzed functions defined here, by the names their memos depend
+        # on; None until the first one is analyzed (see invalidate_memos)
+        self.dependents = None
+
+    def __getstate__(self):
+        # Unpickled functions are analyzed again, which rebuilds dependents
+        return self.symbols, self.parent
+
+    def __setstate__(self, state):
+        self.symbols, self.parent = state
+        self.dependents = None
+
+    def get(self, name):
+        table = self
+        while table is not None:
+            if name in table.symbols:
+                return table.symbols[name]
+            table = table.parent
+        return None
+
+    def set(self, name, value):
+        self.symbols[name] = value
+
+    def remove(self, name):
+        del self.symbols[name]
+
 #######################################
 # function
 #######################################
 
+# Calls the tree-walking engines run one inside another before handing the
+# next one to the VM, whose frame stack is not limited by Python's
+# recursion limit. Each level takes several Python frames.
+MAX_NESTED_CALLS = 40
+
 class Function:
-    def __init__(self, name, body_node, arg_names, parent_context, global_symbol_table):
+    def __init__(self, name, body_node, arg_names, parent_context, symbol_table):
         self.name = name
         self.body_node = body_node
         self.arg_names = arg_names
         self.parent_context = parent_context
-        self.global_symbol_table = global_symbol_table
-
-    def execute(self, args):
+        self.symbol_table = symbol_table
+        self.code = None
+        self.closure = None
+        # Result cache for pure functions. memo_deps holds every global name
+        # the memo depends on; None means the function is a DEFUN that has not
+        # been analyzed yet (see define_function).
+        self.memo = None
+        self.memo_deps = ()
+
+    def __getstate__(self):
+        # Compiled code, closures and memoized results stay in this process;
+        # a copy rebuilds them as it needs them. An analyzed DEFUN goes back
+        # to unanalyzed, while lambdas (memo_deps == ()) are never memoized.
+        state = self.__dict__.copy()
+        state.update(code=None, closure=None, memo=None)
+        if isinstance(self.memo_deps, frozenset):
+            state['memo_deps'] = None
+        # The body is pickled on its own and only unpickled when it is first
+        # used, so loading many functions is quick (see __getattr__)
+        if 'body_node' in state:
+            state['pickled_body'] = pickle.dumps(state.pop('body_node'), pickle.HIGHEST_PROTOCOL)
+        return state
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set: the body of a function
+        # that was unpickled and has not been used since
+        pickled_body = self.__dict__.get('pickled_body')
+        if name != 'body_node' or pickled_body is None:
+            raise AttributeError(name)
+        self.body_node = pickle.loads(pickled_body)
+        del self.__dict__['pickled_body']
+        return self.body_node
+
+    def get_memo(self):
+        if self.memo_deps is None:
+            analyze_purity(self)
+        return self.memo
+
+    def get_code(self):
+        if self.code is None:
+            self.code = Compiler().compile_function(self.name, self.body_node, self.arg_names)
+        return self.code
+
+    def get_closure(self):
+        if self.closure is None:
+            self.closure = ClosureCompiler(self.arg_names).compile(self.body_node)
+        return self.closure
+
+    def execute(self, args, profiler=None, depth=0):
         res = RTResult()
-        interpreter = Interpreter(self.global_symbol_table.copy())
-        new_context = Context(self.name, self.parent_context)
+        func = self
+
+        if depth >= MAX_NESTED_CALLS and profiler is None:
+            value, error = VM(self.symbol_table).call(self, args)
+            return res.failure(error) if error else res.success(value)
+
+        # Pure functions are looked up on entry; the tail calls they make
+        # are not memoized individually.
+        memo = self.memo if self.memo_deps is not None else self.get_memo()
+        if memo is not None:
+            key = make_memo_key(args)
+            value = memo.get(key, _MISSING)
+            if value is not _MISSING:
+                return res.success(value)
+
+        # Calls in tail position come back as TailCall values and are run by
+        # this loop, so tail recursion does not grow the Python stack.
+        while True:
+            if cancelled_sessions: check_cancelled()
+            if len(args) != len(func.arg_names):
+                return res.failure(RTError(
+                    func.body_node.pos_start, func.body_node.pos_end,
+                    f"{len(func.arg_names)} arguments expected, got {len(args)}",
+                    func.parent_context
+                ))
 
-        if len(args) != len(self.arg_names):
-            return res.failure(RTError(
-                self.body_node.pos_start, self.body_node.pos_end,
-                f"{len(self.arg_names)} arguments expected, got {len(args)}",
-                self.parent_context
-            ))
+            # The call frame only holds the arguments; every other name is
+            # resolved through the scope the function was defined in.
+            symbol_table = SymbolTable(func.symbol_table, dict(zip(func.arg_names, args)))
+            context = Context(func.name, func.parent_context)
+            if profiler is None:
+                value = res.register(Interpreter(symbol_table, context, None, depth + 1).visit(func.body_node))
+            else:
+                value = res.register(profiler.call(func, ProfilingInterpreter(symbol_table, context, profiler)))
+            if res.error: return res
 
-        for i in range(len(args)):
-            arg_name = self.arg_names[i]
-            arg_value = args[i]
-            interpreter.global_symbol_table[arg_name] = arg_value
+            if type(value) is not TailCall:
+                if memo is not None:
+                    memo.put(key, value)
+                return res.success(value)
+            func, args = value.function, value.args
 
-        interpreter.context = new_context
-        value = res.register(interpreter.visit(self.body_node))
-        if res.error: return res
-        return res.success(value)
+class TailCall:
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
 
 class Context:
+    __slots__ = ('display_name', 'parent', 'parent_entry_pos', 'symbol_table')
+
     def __init__(self, display_name, parent=None, parent_entry_pos=None):
         self.display_name = display_name
         self.parent = parent
         self.parent_entry_pos = parent_entry_pos
         self.symbol_table = None
 
+#######################################
+# BUILTINS
+#######################################
+
+class BuiltinError(Exception):
+    """Raised by a builtin with the message of the runtime error that is
+    reported at the call."""
+
+
+class Builtin:
+    """A function implemented in Python. Every engine calls it directly,
+    without a Context, symbol table or interpreter for the call. Its
+    arguments are checked to be integers before it runs."""
+
+    __slots__ = ('name', 'function', 'min_args', 'max_args')
+
+    def __init__(self, name, function, min_args, max_args):
+        self.name = name
+        self.function = function
+        self.min_args = min_args
+        # None for any number of arguments from min_args up
+        self.max_args = sys.maxsize if max_args is None else max_args
+
+    def __reduce__(self):
+        # Pickled by name, like Python functions
+        return lookup_builtin, (self.name,)
+
+    def __repr__(self):
+        return f"<builtin {self.name}>"
+
+    def call(self, args):
+        if not self.min_args <= len(args) <= self.max_args:
+            raise BuiltinError(f"{self.arity()} arguments expected, got {len(args)}")
+        for arg in args:
+            if type(arg) is not int:
+                raise BuiltinError(f"{self.name}() expects integer arguments")
+
+        try:
+            return self.function(*args)
+        except ValueError as exception:
+            raise BuiltinError(f"{self.name}(): {exception}") from None
+
+    def arity(self):
+        if self.max_args == self.min_args:
+            return str(self.min_args)
+        if self.max_args == sys.maxsize:
+            return f"at least {self.min_args}"
+        return f"{self.min_args} to {self.max_args}"
+
+
+# Functions every program can call unless it defines its own with that name
+BUILTINS = {}
+
+
+def register_builtin(name, function, min_args, max_args):
+    """Adds a builtin taking min_args to max_args arguments (None for no
+    limit). function is called with the integer arguments and returns the
+    result; a ValueError it raises becomes a runtime error."""
+    BUILTINS[name] = Builtin(name, function, min_args, max_args)
+
+
+def lookup_builtin(name):
+    return BUILTINS[name]
+
+
+# Largest result pow() computes without a modulus. A power is one operation
+# inside Python, so neither Session.cancel() nor a server timeout can stop it.
+MAX_POW_BITS = 1 << 20
+
+
+def builtin_pow(base, exponent, modulus=None):
+    if modulus is None:
+        if exponent < 0:
+            raise ValueError("negative exponent without a modulus")
+        # exponent * bit_length bounds the size of the result from above;
+        # 0, 1 and -1 stay that small whatever the exponent
+        if abs(base) > 1 and exponent * base.bit_length() > MAX_POW_BITS:
+            raise ValueError(f"result would have more than {MAX_POW_BITS} bits")
+        return base ** exponent
+    if modulus == 0:
+        raise ValueError("zero modulus")
+    # A negative exponent takes the modular inverse
+    return pow(base, exponent, modulus)
+
+
+def builtin_sqrt(value):
+    if value < 0:
+        raise ValueError("square root of a negative number")
+    return math.isqrt(value)
+
+
+register_builtin('abs', abs, 1, 1)
+register_builtin('min', lambda *args: min(args), 1, None)
+register_builtin('max', lambda *args: max(args), 1, None)
+register_builtin('pow', builtin_pow, 2, 3)
+register_builtin('gcd', math.gcd, 1, None)
+register_builtin('sqrt', builtin_sqrt, 1, 1)
+
+#######################################
+# MEMOIZATION
+#######################################
+
+def define_function(symbol_table, func_value):
+    # Only DEFUNs are memoized; they are analyzed lazily on their first call
+    func_value.memo_deps = None
+    previous = symbol_table.symbols.get(func_value.name)
+    if isinstance(previous, Function):
+        forget_dependencies(symbol_table, previous)
+    symbol_table.set(func_value.name, func_value)
+    invalidate_memos(symbol_table, func_value.name)
+
+
+def invalidate_memos(symbol_table, name):
+    # Only the functions whose memos depend on name are looked at, so a
+    # definition costs the same however many functions there are
+    if not symbol_table.dependents:
+        return
+    for value in symbol_table.dependents.pop(name, ()):
+        forget_dependencies(symbol_table, value)
+        value.memo = None
+        value.memo_deps = None
+
+
+def add_dependencies(symbol_table, func_value):
+    if symbol_table.dependents is None:
+        symbol_table.dependents = {}
+    for name in func_value.memo_deps:
+        symbol_table.dependents.setdefault(name, set()).add(func_value)
+
+
+def forget_dependencies(symbol_table, func_value):
+    if not func_value.memo_deps or not symbol_table.dependents:
+        return
+    for name in func_value.memo_deps:
+        dependents = symbol_table.dependents.get(name)
+        if dependents is not None:
+            dependents.discard(func_value)
+            if not dependents:
+                del symbol_table.dependents[name]
+
+
+def make_memo_key(args):
+    # true == 1 in Python, so the types take part in the key unless every
+    # argument is a plain int
+    for arg in args:
+        if type(arg) is not int:
+            return tuple((type(arg), arg) for arg in args)
+    return tuple(args)
+
+
+def analyze_purity(func_value):
+    deps = set()
+    pure = _is_pure(func_value.body_node, set(func_value.arg_names), func_value, deps, {func_value})
+
+    memo_cache_size = current_session().memo_cache_size
+    func_value.memo_deps = frozenset(deps)
+    func_value.memo = LRUCache(memo_cache_size) if pure and memo_cache_size > 0 else None
+    add_dependencies(func_value.symbol_table, func_value)
+    return func_value.memo
+
+
+def _is_pure(node, local_names, func_value, deps, visiting):
+    # The only side effect in the language is the print in a FOR loop. Lambda
+    # values are treated as impure because a cached call would hand back the
+    # same function object instead of a new one.
+    if isinstance(node, (NumberNode, BooleanNode)):
+        return True
+    elif isinstance(node, IdentifierNode):
+        if node.tok.value not in local_names:
+            deps.add(node.tok.value)
+        return True
+    elif isinstance(node, BinOpNode):
+        return (_is_pure(node.left_node, local_names, func_value, deps, visiting) and
+                _is_pure(node.right_node, local_names, func_value, deps, visiting))
+    elif isinstance(node, UnaryOpNode):
+        return _is_pure(node.node, local_names, func_value, deps, visiting)
+    elif isinstance(node, IfNode):
+        for condition, expr in node.cases:
+            if not (_is_pure(condition, local_names, func_value, deps, visiting) and
+                    _is_pure(expr, local_names, func_value, deps, visiting)):
+                return False
+        return node.else_case is None or _is_pure(node.else_case, local_names, func_value, deps, visiting)
+    elif isinstance(node, FunctionCallNode):
+        for arg_node in node.arg_nodes:
+            if not _is_pure(arg_node, local_names, func_value, deps, visiting):
+                return False
+
+        callee = node.name_tok
+        if isinstance(callee, LambdaNode):
+            lambda_names = local_names | {arg_tok.value for arg_tok in callee.arg_name_toks}
+            return _is_pure(callee.body_node, lambda_names, func_value, deps, visiting)
+        if not isinstance(callee, IdentifierNode):
+            return False
+
+        callee_name = callee.tok.value
+        if callee_name in local_names:
+            # Calling an argument: nothing is known about it
+            return False
+
+        deps.add(callee_name)
+        callee_value = func_value.symbol_table.get(callee_name)
+        if callee_value is None and callee_name in BUILTINS:
+            return True
+        if not isinstance(callee_value, Function):
+            return False
+        if callee_value in visiting:
+            return True
+        if callee_value.memo_deps is not None:
+            # Already analyzed on its own
+            deps.update(callee_value.memo_deps)
+            return callee_value.memo is not None
+
+        visiting.add(callee_value)
+        return _is_pure(callee_value.body_node, set(callee_value.arg_names), callee_value, deps, visiting)
+    return False
+
+
+def memo_stats(symbol_table=None):
+    symbol_table = symbol_table or current_session().symbol_table
+    return {
+        name: value.memo.stats()
+        for name, value in symbol_table.symbols.items()
+        if isinstance(value, Function) and value.memo is not None
+    }
+
+#######################################
+# LOOPS
+#######################################
+
+class OutputSink:
+    """Collects the values FOR loops print and writes them in batches."""
+
+    def __init__(self, stream=None, batch_size=4096):
+        # stream None writes to whatever sys.stdout is when flushing
+        self.stream = stream
+        self.batch_size = batch_size
+        self.lines = []
+
+    def write(self, value):
+        self.lines.append(str(value))
+        if len(self.lines) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            stream = self.stream or sys.stdout
+            stream.write('\n'.join(self.lines) + '\n')
+            self.lines.clear()
+
+
+class DiscardOutput:
+    def write(self, value):
+        pass
+
+    def flush(self):
+        pass
+
+
+def loop_values(start_value, end_value, step_value):
+    # Integer bounds with a positive step run on range(); anything else keeps
+    # the plain "while current <= end" stepping.
+    if type(start_value) is int and type(end_value) is int and type(step_value) is int and step_value > 0:
+        return range(start_value, end_value + 1, step_value)
+    return _stepped_values(start_value, end_value, step_value)
+
+
+def _stepped_values(current_value, end_value, step_value):
+    while current_value <= end_value:
+        yield current_value
+        current_value += step_value
+
+
 #######################################
 # INTERPRETER
 #######################################
 
 class RTResult:
+    __slots__ = ('value', 'error')
+
     def __init__(self):
         self.value = None
         self.error = None
@@ -1011,23 +1962,29 @@ class RTResult:
         return self
 
 class Interpreter:
-    def __init__(self, global_symbol_table):
-        self.global_symbol_table = global_symbol_table
-        self.context = Context('<program>')
+    def __init__(self, symbol_table, context=None, profiler=None, depth=0):
+        self.symbol_table = symbol_table
+        self.context = context or Context('<program>')
+        self.profiler = profiler
+        # Function calls this one is running inside of (see MAX_NESTED_CALLS)
+        self.depth = depth
 
     def visit(self, node):
         method_name = f'visit_{type(node).__name__}'
         method = getattr(self, method_name, self.no_visit_method)
         return method(node)
 
+    def get_visit_method(self, node):
+        return getattr(self, f'visit_{type(node).__name__}', self.no_visit_method)
+
     def visit_FunctionDefNode(self, node):
         res = RTResult()
         func_name = node.name_tok.value
         body_node = node.body_node
         arg_names = [arg_tok.value for arg_tok in node.arg_name_toks]
-        func_value = Function(func_name, body_node, arg_names, self.context, self.global_symbol_table)
+        func_value = Function(func_name, body_node, arg_names, self.context, self.symbol_table)
 
-        self.global_symbol_table[func_name] = func_value
+        define_function(self.symbol_table, func_value)
         return res.success(f"Function '{func_name}' defined successfully")
 
     def visit_FunctionCallNode(self, node):
@@ -1037,13 +1994,16 @@ class Interpreter:
         if isinstance(node.name_tok, LambdaNode):
             func_value = res.register(self.visit_LambdaNode(node.name_tok))
         elif isinstance(node.name_tok, IdentifierNode):
-            func_value = self.global_symbol_table.get(node.name_tok.tok.value)
+            func_value = self.symbol_table.get(node.name_tok.tok.value)
         else:
             func_value = res.register(self.visit(node.name_tok))
 
         if res.error:
             return res
 
+        if func_value is None and isinstance(node.name_tok, IdentifierNode):
+            func_value = BUILTINS.get(node.name_tok.tok.value)
+
         if not func_value:
             return res.failure(RTError(
                 node.pos_start, node.pos_end,
@@ -1055,27 +2015,38 @@ class Interpreter:
             args.append(res.register(self.visit(arg_node)))
             if res.error: return res
 
-        return_value = res.register(func_value.execute(args))
+        if type(func_value) is Builtin:
+            try:
+                return res.success(func_value.call(args))
+            except BuiltinError as exception:
+                return res.failure(RTError(node.pos_start, node.pos_end, str(exception), self.context))
+
+        if node.is_tail:
+            return res.success(TailCall(func_value, args))
+
+        return_value = res.register(func_value.execute(args, self.profiler, self.depth))
         if res.error: return res
         return res.success(return_value)
 
     def visit_IdentifierNode(self, node):
         var_name = node.tok.value
-        value = self.global_symbol_table.get(var_name)
+        value = self.symbol_table.get(var_name)
 
         if value is None:
-            return RTResult().failure(RTError(
-                node.pos_start, node.pos_end,
-                f"'{var_name}' is not defined",
-                self.context
-            ))
+            value = BUILTINS.get(var_name)
+            if value is None:
+                return RTResult().failure(RTError(
+                    node.pos_start, node.pos_end,
+                    f"'{var_name}' is not defined",
+                    self.context
+                ))
 
         return RTResult().success(value)
 
     def visit_VarAccessNode(self, node):
         res = RTResult()
         var_name = node.var_name_tok.value
-        value = self.global_symbol_table.get(var_name)
+        value = self.symbol_table.get(var_name)
 
         if value is None:
             return res.failure(RuntimeError(
@@ -1100,40 +2071,14 @@ class Interpreter:
         right = res.register(self.visit(node.right_node))
         if res.error: return res
 
-        if node.op_tok.type == T_DIV:
-            if right == 0:
-                pos_start = node.op_tok.pos_start if node.op_tok.pos_start else node.left_node.pos_start
-                pos_end = node.op_tok.pos_end if node.op_tok.pos_end else node.right_node.pos_end
-                return res.failure(DivisionByZeroError(
-                    pos_start, pos_end
-                ))
-            result = left // right
-        elif node.op_tok.type == T_PLUS:
-            result = left + right
-        elif node.op_tok.type == T_SUB:
-            result = left - right
-        elif node.op_tok.type == T_MUL:
-            result = left * right
-        elif node.op_tok.type == T_MODULO:
-            result = left % right
-        elif node.op_tok.type == T_EQEQ:
-            result = left == right
-        elif node.op_tok.type == T_NOTEQUAL:
-            result = left != right
-        elif node.op_tok.type == T_GREATERTHAN:
-            result = left > right
-        elif node.op_tok.type == T_LESSTHAN:
-            result = left < right
-        elif node.op_tok.type == T_EQGREATERTHAN:
-            result = left >= right
-        elif node.op_tok.type == T_EQLESSTHAN:
-            result = left <= right
-        elif node.op_tok.type == T_AND:
-            result = left if not left else right
-        elif node.op_tok.type == T_OR:
-            result = left if left else right
-
-        return res.success(result)
+        try:
+            return res.success(node.op_func(left, right))
+        except ZeroDivisionError:
+            if node.op_tok.type != T_DIV: raise
+        except TypeError:
+            # Still a division by zero when the left operand isn't a number
+            if node.op_tok.type != T_DIV or right != 0: raise
+        return res.failure(division_by_zero_error(node))
 
     def visit_UnaryOpNode(self, node):
         res = RTResult()
@@ -1178,16 +2123,29 @@ class Interpreter:
         else:
             step_value = 1
 
-        current_value = start_value
+        # The loop variable gets a scope of its own, updated in place, and the
+        # body's visit method is looked up once for the whole loop.
+        if node.var_name_tok:
+            var_name = node.var_name_tok.value
+            symbols = {}
+            body_interpreter = type(self)(SymbolTable(self.symbol_table, symbols), self.context, self.profiler,
+                                          self.depth)
+        else:
+            var_name = None
+            body_interpreter = self
+        body_node = node.body_node
+        visit_body = body_interpreter.get_visit_method(body_node)
+        write = current_session().loop_output.write
         last_value = None
 
-        while current_value <= end_value:
-            last_value = res.register(self.visit(node.body_node))
+        for current_value in loop_values(start_value, end_value, step_value):
+            if cancelled_sessions: check_cancelled()
+            if var_name:
+                symbols[var_name] = current_value
+            last_value = res.register(visit_body(body_node))
             if res.error: return res
 
-            print(last_value)
-
-            current_value += step_value
+            write(last_value)
 
         return res.success(last_value)
 
@@ -1197,30 +2155,1780 @@ class Interpreter:
         func_name = f"<anonymous_{id(node)}>"
         body_node = node.body_node
         arg_names = [arg_tok.value for arg_tok in node.arg_name_toks]
-        func_value = Function(func_name, body_node, arg_names, self.context, self.global_symbol_table)
+        func_value = Function(func_name, body_node, arg_names, self.context, self.symbol_table)
 
         return res.success(func_value)
 
 
 #######################################
-# RUN
+# PROFILER
+#######################################
+
+class Profiler:
+    """Collects where a run on the 'interpreter' engine spends its time:
+    calls and self/total time per function, visits per node type, name
+    lookups, and parse cache and memo hits. Pass the same Profiler to any
+    number of run(..., profiler=profiler) calls to add them up."""
+
+    def __init__(self):
+        self.time = 0.0
+        # Function name -> [calls, total time, self time]
+        self.functions = {}
+        self.node_counts = {}
+        self.lookups = 0
+        self.scopes_searched = 0
+        self.parse_cache = {'hits': 0, 'misses': 0}
+        self.memo = {}
+        # Calls of each function currently running, so that recursive calls
+        # only add to its total time once
+        self.active = {}
+        # Time spent in callees, for each call currently running
+        self.callee_time = [0.0]
+
+    def run(self, session, fn, text, optimize=True, lexer='reference'):
+        parse_hits = session.parse_cache.hits
+        node, error = session.parse(fn, text, optimize, lexer)
+        self.parse_cache['hits' if session.parse_cache.hits > parse_hits else 'misses'] += 1
+        if error: return None, error
+
+        memo_before = session.memo_stats()
+        start = time.perf_counter()
+        try:
+            result = ProfilingInterpreter(session.symbol_table, profiler=self).visit(node)
+        except RecursionError:
+            # Profiled calls are not handed to the VM
+            result = RTResult().failure(statement_error(node, "Maximum recursion depth exceeded"))
+        except EvaluationCancelled:
+            result = RTResult().failure(statement_error(node, "Evaluation cancelled"))
+        finally:
+            self.time += time.perf_counter() - start
+            session.loop_output.flush()
+            self.count_memo_hits(memo_before, session.memo_stats())
+
+        return result.value, result.error
+
+    def call(self, func, interpreter):
+        stats = self.functions.get(func.name)
+        if stats is None:
+            stats = self.functions[func.name] = [0, 0.0, 0.0]
+        stats[0] += 1
+
+        depth = self.active.get(func.name, 0)
+        self.active[func.name] = depth + 1
+        self.callee_time.append(0.0)
+        start = time.perf_counter()
+        try:
+            return interpreter.visit(func.body_node)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.active[func.name] = depth
+            stats[2] += elapsed - self.callee_time.pop()
+            self.callee_time[-1] += elapsed
+            if depth == 0:
+                stats[1] += elapsed
+
+    def count_lookup(self, symbol_table, name):
+        self.lookups += 1
+        table = symbol_table
+        while table is not None:
+            self.scopes_searched += 1
+            if name in table.symbols:
+                return
+            table = table.parent
+
+    def count_memo_hits(self, before, after):
+        for name, stats in after.items():
+            previous = before.get(name)
+            # A memo that was cleared or created during the run starts from zero
+            if previous is None or stats['hits'] < previous['hits'] or stats['misses'] < previous['misses']:
+                previous = {'hits': 0, 'misses': 0}
+            counts = self.memo.setdefault(name, {'hits': 0, 'misses': 0})
+            counts['hits'] += stats['hits'] - previous['hits']
+            counts['misses'] += stats['misses'] - previous['misses']
+
+    def report(self):
+        return {
+            'time': self.time,
+            'functions': {
+                name: {'calls': calls, 'total_time': total_time, 'self_time': self_time}
+                for name, (calls, total_time, self_time) in self.functions.items()
+            },
+            'nodes': dict(self.node_counts),
+            'lookups': {'count': self.lookups, 'scopes_searched': self.scopes_searched},
+            'caches': {
+                'parse': dict(self.parse_cache),
+                'memo': {name: dict(counts) for name, counts in self.memo.items() if counts['hits'] or counts['misses']},
+            },
+        }
+
+    def print_stats(self, sort='self_time', stream=None):
+        """Prints the report as text tables; sort is 'calls', 'self_time'
+        or 'total_time'."""
+        stream = stream or sys.stdout
+        report = self.report()
+        functions = sorted(report['functions'].items(), key=lambda item: item[1][sort], reverse=True)
+
+        call_count = sum(stats['calls'] for name, stats in functions)
+        print(f"{call_count} function calls in {report['time']:.3f} seconds", file=stream)
+        print(file=stream)
+        print(f"{'ncalls':>9} {'tottime':>9} {'percall':>9} {'cumtime':>9} {'percall':>9}  function", file=stream)
+        for name, stats in functions:
+            calls = stats['calls']
+            print(f"{calls:>9} {stats['self_time']:>9.3f} {stats['self_time'] / calls:>9.6f}"
+                  f" {stats['total_time']:>9.3f} {stats['total_time'] / calls:>9.6f}  {name}", file=stream)
+
+        print(file=stream)
+        print(f"{'visits':>9}  node type", file=stream)
+        for name, count in sorted(report['nodes'].items(), key=lambda item: item[1], reverse=True):
+            print(f"{count:>9}  {name}", file=stream)
+
+        lookups = report['lookups']
+        average = lookups['scopes_searched'] / lookups['count'] if lookups['count'] else 0
+        print(file=stream)
+        print(f"{lookups['count']} name lookups, {average:.2f} scopes searched per lookup", file=stream)
+        parse_stats = report['caches']['parse']
+        print(f"parse cache: {parse_stats['hits']} hits, {parse_stats['misses']} misses", file=stream)
+        for name, counts in sorted(report['caches']['memo'].items()):
+            print(f"memo {name}: {counts['hits']} hits, {counts['misses']} misses", file=stream)
+
+
+class ProfilingInterpreter(Interpreter):
+    """Interpreter that reports every node it visits and every name it looks
+    up to its Profiler. Runs without a profiler never create one, so they
+    pay nothing for these counters."""
+
+    def visit(self, node):
+        node_counts = self.profiler.node_counts
+        node_type = type(node).__name__
+        node_counts[node_type] = node_counts.get(node_type, 0) + 1
+        return Interpreter.visit(self, node)
+
+    def get_visit_method(self, node):
+        # Loop bodies go through visit, so they are counted as well
+        return self.visit
+
+    def visit_FunctionCallNode(self, node):
+        if isinstance(node.name_tok, IdentifierNode):
+            self.profiler.count_lookup(self.symbol_table, node.name_tok.tok.value)
+        return Interpreter.visit_FunctionCallNode(self, node)
+
+    def visit_IdentifierNode(self, node):
+        self.profiler.count_lookup(self.symbol_table, node.tok.value)
+        return Interpreter.visit_IdentifierNode(self, node)
+
+
+#######################################
+# BYTECODE
+#######################################
+
+OP_LOAD_CONST = 'LOAD_CONST'
+OP_LOAD_FAST = 'LOAD_FAST'
+OP_LOAD_NAME = 'LOAD_NAME'
+OP_LOAD_CALLEE_FAST = 'LOAD_CALLEE_FAST'
+OP_LOAD_CALLEE = 'LOAD_CALLEE'
+OP_BINARY_OP = 'BINARY_OP'
+OP_BINARY_DIV = 'BINARY_DIV'
+OP_UNARY_NOT = 'UNARY_NOT'
+OP_UNARY_NEG = 'UNARY_NEG'
+OP_JUMP = 'JUMP'
+OP_JUMP_IF_FALSE = 'JUMP_IF_FALSE'
+OP_FOR_SETUP = 'FOR_SETUP'
+OP_FOR_ITER = 'FOR_ITER'
+OP_FOR_STEP = 'FOR_STEP'
+OP_MAKE_LAMBDA = 'MAKE_LAMBDA'
+OP_MAKE_FUNCTION = 'MAKE_FUNCTION'
+OP_CALL = 'CALL'
+OP_TAIL_CALL = 'TAIL_CALL'
+OP_RETURN = 'RETURN'
+
+class Bytecode:
+    def __init__(self, name, arg_names):
+        self.name = name
+        self.arg_names = arg_names
+        self.instructions = []
+
+    def emit(self, op, arg=None):
+        self.instructions.append((op, arg))
+        return len(self.instructions) - 1
+
+    def patch(self, index, arg):
+        self.instructions[index] = (self.instructions[index][0], arg)
+
+    def here(self):
+        return len(self.instructions)
+
+    def __repr__(self):
+        lines = [f'Bytecode {self.name}({", ".join(self.arg_names)})']
+        for i, (op, arg) in enumerate(self.instructions):
+            if isinstance(arg, tuple): arg = arg[0]
+            lines.append(f'  {i:4} {op:<18} {"" if arg is None else arg}')
+        return '\n'.join(lines)
+
+
 #######################################
-global_symbol_table = {}
+# COMPILER
+#######################################
+
+class Compiler:
+    def __init__(self, name='<program>', arg_names=()):
+        self.code = Bytecode(name, list(arg_names))
+        # Loop variables in scope; they shadow arguments of the same name
+        self.loop_names = []
+
+    def compile_function(self, name, body_node, arg_names):
+        compiler = Compiler(name, arg_names)
+        compiler.compile(body_node)
+        compiler.code.emit(OP_RETURN)
+        return compiler.code
+
+    def compile_program(self, node):
+        self.compile(node)
+        self.code.emit(OP_RETURN)
+        return self.code
+
+    def compile(self, node):
+        method_name = f'compile_{type(node).__name__}'
+        method = getattr(self, method_name, self.no_compile_method)
+        method(node)
+
+    def no_compile_method(self, node):
+        raise Exception(f'No compile_{type(node).__name__} method')
+
+    def compile_NumberNode(self, node):
+        self.code.emit(OP_LOAD_CONST, node.tok.value)
+
+    def compile_BooleanNode(self, node):
+        self.code.emit(OP_LOAD_CONST, node.tok.value)
+
+    def compile_IdentifierNode(self, node):
+        var_name = node.tok.value
+        if var_name in self.code.arg_names and var_name not in self.loop_names:
+            self.code.emit(OP_LOAD_FAST, self.code.arg_names.index(var_name))
+        else:
+            self.code.emit(OP_LOAD_NAME, (var_name, node))
+
+    def compile_BinOpNode(self, node):
+        self.compile(node.left_node)
+        self.compile(node.right_node)
+
+        if node.op_tok.type == T_DIV:
+            self.code.emit(OP_BINARY_DIV, node)
+        else:
+            self.code.emit(OP_BINARY_OP, node.op_func)
+
+    def compile_UnaryOpNode(self, node):
+        self.compile(node.node)
+
+        if node.op_tok.type == T_NOT:
+            self.code.emit(OP_UNARY_NOT)
+        elif node.op_tok.type == T_SUB:
+            self.code.emit(OP_UNARY_NEG)
+
+    def compile_IfNode(self, node):
+        end_jumps = []
+
+        for condition, expr in node.cases:
+            self.compile(condition)
+            jump_if_false = self.code.emit(OP_JUMP_IF_FALSE)
+            self.compile(expr)
+            end_jumps.append(self.code.emit(OP_JUMP))
+            self.code.patch(jump_if_false, self.code.here())
+
+        if node.else_case:
+            self.compile(node.else_case)
+        else:
+            self.code.emit(OP_LOAD_CONST, None)
+
+        for jump in end_jumps:
+            self.code.patch(jump, self.code.here())
+
+    def compile_ForNode(self, node):
+        self.compile(node.start_value_node)
+        self.compile(node.end_value_node)
+        if node.step_value_node:
+            self.compile(node.step_value_node)
+        else:
+            self.code.emit(OP_LOAD_CONST, 1)
+
+        var_name = node.var_name_tok.value if node.var_name_tok else None
+        self.code.emit(OP_FOR_SETUP, var_name)
+        loop_start = self.code.emit(OP_FOR_ITER)
+        if var_name: self.loop_names.append(var_name)
+        self.compile(node.body_node)
+        if var_name: self.loop_names.pop()
+        self.code.emit(OP_FOR_STEP, loop_start)
+        self.code.patch(loop_start, self.code.here())
+
+    def compile_FunctionDefNode(self, node):
+        arg_names = [arg_tok.value for arg_tok in node.arg_name_toks]
+        code = self.compile_function(node.name_tok.value, node.body_node, arg_names)
+        self.code.emit(OP_MAKE_FUNCTION, (node, code))
+
+    def compile_LambdaNode(self, node):
+        arg_names = [arg_tok.value for arg_tok in node.arg_name_toks]
+        code = self.compile_function(f"<anonymous_{id(node)}>", node.body_node, arg_names)
+        self.code.emit(OP_MAKE_LAMBDA, (node, code))
+
+    def compile_FunctionCallNode(self, node):
+        callee = node.name_tok
+
+        if isinstance(callee, IdentifierNode):
+            func_name = callee.tok.value
+            if func_name in self.code.arg_names and func_name not in self.loop_names:
+                self.code.emit(OP_LOAD_CALLEE_FAST, (self.code.arg_names.index(func_name), node))
+            else:
+                self.code.emit(OP_LOAD_CALLEE, (func_name, node))
+        else:
+            self.compile(callee)
+
+        for arg_node in node.arg_nodes:
+            self.compile(arg_node)
+
+        self.code.emit(OP_TAIL_CALL if node.is_tail else OP_CALL, (len(node.arg_nodes), node))
+
+
+#######################################
+# VIRTUAL MACHINE
+#######################################
+
+class VM:
+    def __init__(self, symbol_table, context=None):
+        self.symbol_table = symbol_table
+        self.context = context or Context('<program>')
+
+    def call(self, func_value, args):
+        # Runs a single call, and every call it makes, on the VM's frame stack
+        code = Bytecode(func_value.name, [])
+        code.emit(OP_LOAD_CONST, func_value)
+        for arg in args:
+            code.emit(OP_LOAD_CONST, arg)
+        code.emit(OP_CALL, (len(args), None))
+        code.emit(OP_RETURN)
+        return self.run(code)
+
+    def run(self, code):
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        frames = []
+
+        instructions = code.instructions
+        ip = 0
+        locals_ = []
+        env = self.symbol_table
+        func = None
+        context = self.context
+        memo_entry = None
+        write = current_session().loop_output.write
+        cancelled = cancelled_sessions
+
+        while True:
+            op, arg = instructions[ip]
+            ip += 1
+
+            if op == OP_LOAD_FAST:
+                push(locals_[arg])
+            elif op == OP_LOAD_CONST:
+                push(arg)
+            elif op == OP_BINARY_OP:
+                right = pop()
+                stack[-1] = arg(stack[-1], right)
+            elif op == OP_JUMP_IF_FALSE:
+                if not pop():
+                    ip = arg
+            elif op == OP_JUMP:
+                ip = arg
+            elif op == OP_FOR_ITER:
+                # loop state: [values, last_value, var_name]
+                if cancelled: check_cancelled()
+                loop = stack[-1]
+                current_value = next(loop[0], _MISSING)
+                if current_value is _MISSING:
+                    stack[-1] = loop[1]
+                    if loop[2]: env = env.parent
+                    ip = arg
+                elif loop[2]:
+                    env.symbols[loop[2]] = current_value
+            elif op == OP_FOR_STEP:
+                last_value = pop()
+                write(last_value)
+                stack[-1][1] = last_value
+                ip = arg
+            elif op == OP_LOAD_CALLEE or op == OP_LOAD_CALLEE_FAST:
+                if op == OP_LOAD_CALLEE:
+                    func_name, node = arg
+                    func_value = env.get(func_name)
+                else:
+                    func_value = locals_[arg[0]]
+                    node = arg[1]
+                    func_name = node.name_tok.tok.value
+
+                if not func_value:
+                    builtin = BUILTINS.get(func_name) if func_value is None else None
+                    if builtin is None:
+                        if context is None: context = Context(func.name, func.parent_context)
+                        return None, RTError(
+                            node.pos_start, node.pos_end,
+                            f"'{func_name}'  is not defined",
+                            context
+                        )
+                    func_value = builtin
+                push(func_value)
+            elif op == OP_CALL or op == OP_TAIL_CALL:
+                arg_count, node = arg
+                if arg_count:
+                    args = stack[-arg_count:]
+                    del stack[-arg_count:]
+                else:
+                    args = []
+                callee = pop()
+
+                # Builtins run right here, in tail position too: the function
+                # returns right after a tail call, so the result just needs
+                # to be on the stack
+                if type(callee) is Builtin:
+                    try:
+                        push(callee.call(args))
+                    except BuiltinError as exception:
+                        if context is None: context = Context(func.name, func.parent_context)
+                        return None, RTError(node.pos_start, node.pos_end, str(exception), context)
+                    continue
+
+                if cancelled: check_cancelled()
+                if len(args) != len(callee.arg_names):
+                    return None, RTError(
+                        callee.body_node.pos_start, callee.body_node.pos_end,
+                        f"{len(callee.arg_names)} arguments expected, got {len(args)}",
+                        callee.parent_context
+                    )
+
+                # A tail call replaces the current frame instead of stacking a
+                # new one; its result becomes the result of the current frame,
+                # so only regular calls consult the memo.
+                if op == OP_CALL:
+                    memo = callee.memo if callee.memo_deps is not None else callee.get_memo()
+                    if memo is not None:
+                        key = make_memo_key(args)
+                        value = memo.get(key, _MISSING)
+                        if value is not _MISSING:
+                            push(value)
+                            continue
+                    frames.append((instructions, ip, locals_, env, func, context, memo_entry))
+                    memo_entry = (memo, key) if memo is not None else None
+
+                instructions = callee.get_code().instructions
+                ip = 0
+                locals_ = args
+                env = callee.symbol_table
+                func = callee
+                context = None
+            elif op == OP_RETURN:
+                if memo_entry is not None:
+                    memo_entry[0].put(memo_entry[1], stack[-1])
+                if not frames:
+                    return pop(), None
+                instructions, ip, locals_, env, func, context, memo_entry = frames.pop()
+            elif op == OP_BINARY_DIV:
+                right = pop()
+                if right == 0:
+                    return None, division_by_zero_error(arg)
+                stack[-1] = stack[-1] // right
+            elif op == OP_LOAD_NAME:
+                var_name, node = arg
+                value = env.get(var_name)
+
+                if value is None:
+                    value = BUILTINS.get(var_name)
+                    if value is None:
+                        if context is None: context = Context(func.name, func.parent_context)
+                        return None, RTError(
+                            node.pos_start, node.pos_end,
+                            f"'{var_name}' is not defined",
+                            context
+                        )
+                push(value)
+            elif op == OP_UNARY_NOT:
+                stack[-1] = not stack[-1]
+            elif op == OP_UNARY_NEG:
+                stack[-1] = -stack[-1]
+            elif op == OP_FOR_SETUP:
+                step_value = pop()
+                end_value = pop()
+                start_value = pop()
+                # A named loop variable lives in a scope pushed for the loop,
+                # above a scope holding the arguments so lambdas made in the
+                # loop see the loop variable first, as in the interpreter
+                if arg:
+                    if func is not None and env is func.symbol_table:
+                        env = SymbolTable(env, dict(zip(func.arg_names, locals_)))
+                    env = SymbolTable(env, {})
+                push([iter(loop_values(start_value, end_value, step_value)), None, arg])
+            elif op == OP_MAKE_LAMBDA:
+                node, lambda_code = arg
+                if context is None: context = Context(func.name, func.parent_context)
+                if func is None or env is not func.symbol_table:
+                    # At the top level, or the arguments are already in scope
+                    symbol_table = env
+                else:
+                    symbol_table = SymbolTable(env, dict(zip(func.arg_names, locals_)))
+                func_value = Function(lambda_code.name, node.body_node, lambda_code.arg_names, context, symbol_table)
+                func_value.code = lambda_code
+                push(func_value)
+            elif op == OP_MAKE_FUNCTION:
+                node, func_code = arg
+                func_value = Function(func_code.name, node.body_node, func_code.arg_names, context, env)
+                func_value.code = func_code
+                define_function(env, func_value)
+                push(f"Function '{func_code.name}' defined successfully")
+            else:
+                raise Exception(f'Unknown opcode {op}')
+
+
+#######################################
+# CLOSURE COMPILER
+#######################################
+
+class ClosureFrame:
+    __slots__ = ('args', 'symbol_table', 'function', 'context', 'depth')
+
+    def __init__(self, args, symbol_table, function=None, context=None, depth=0):
+        self.args = args
+        self.symbol_table = symbol_table
+        self.function = function
+        self.context = context
+        # Function calls this one is running inside of (see MAX_NESTED_CALLS)
+        self.depth = depth
+
+    def get_context(self):
+        if self.context is None:
+            self.context = Context(self.function.name, self.function.parent_context)
+        return self.context
+
+    def scope(self):
+        # The symbol table with the arguments in it, for lambdas and loops.
+        # Loop scopes go above the arguments, as in the interpreter.
+        if self.function is None or self.symbol_table is not self.function.symbol_table:
+            return self.symbol_table
+        return SymbolTable(self.symbol_table, dict(zip(self.function.arg_names, self.args)))
+
+
+def call_closure_function(func_value, args, depth=0):
+    if depth >= MAX_NESTED_CALLS:
+        value, error = VM(func_value.symbol_table).call(func_value, args)
+        if error: raise RTException(error)
+        return value
+
+    memo = func_value.memo if func_value.memo_deps is not None else func_value.get_memo()
+    if memo is not None:
+        key = make_memo_key(args)
+        value = memo.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+    # Trampoline: tail calls return a TailCall instead of recursing
+    while True:
+        if cancelled_sessions: check_cancelled()
+        if len(args) != len(func_value.arg_names):
+            raise RTException(RTError(
+                func_value.body_node.pos_start, func_value.body_node.pos_end,
+                f"{len(func_value.arg_names)} arguments expected, got {len(args)}",
+                func_value.parent_context
+            ))
+
+        body = func_value.closure or func_value.get_closure()
+        value = body(ClosureFrame(args, func_value.symbol_table, func_value, None, depth + 1))
+
+        if type(value) is not TailCall:
+            if memo is not None:
+                memo.put(key, value)
+            return value
+        func_value, args = value.function, value.args
+
+
+def _closure_and(left, right):
+    def and_(env):
+        left_value = left(env)
+        right_value = right(env)
+        return left_value if not left_value else right_value
+    return and_
+
+
+def _closure_or(left, right):
+    def or_(env):
+        left_value = left(env)
+        right_value = right(env)
+        return left_value if left_value else right_value
+    return or_
+
+
+CLOSURE_BINARY_OPS = {
+    T_PLUS: lambda l, r: lambda env: l(env) + r(env),
+    T_SUB: lambda l, r: lambda env: l(env) - r(env),
+    T_MUL: lambda l, r: lambda env: l(env) * r(env),
+    T_MODULO: lambda l, r: lambda env: l(env) % r(env),
+    T_EQEQ: lambda l, r: lambda env: l(env) == r(env),
+    T_NOTEQUAL: lambda l, r: lambda env: l(env) != r(env),
+    T_GREATERTHAN: lambda l, r: lambda env: l(env) > r(env),
+    T_LESSTHAN: lambda l, r: lambda env: l(env) < r(env),
+    T_EQGREATERTHAN: lambda l, r: lambda env: l(env) >= r(env),
+    T_EQLESSTHAN: lambda l, r: lambda env: l(env) <= r(env),
+    T_AND: _closure_and,
+    T_OR: _closure_or,
+}
+
+
+class ClosureCompiler:
+    def __init__(self, arg_names=()):
+        self.arg_names = list(arg_names)
+        # Loop variables in scope; they shadow arguments of the same name
+        self.loop_names = []
+
+    def compile(self, node):
+        method_name = f'compile_{type(node).__name__}'
+        method = getattr(self, method_name, self.no_compile_method)
+        return method(node)
+
+    def no_compile_method(self, node):
+        raise Exception(f'No compile_{type(node).__name__} method')
+
+    def compile_NumberNode(self, node):
+        value = node.tok.value
+        return lambda env: value
+
+    def compile_BooleanNode(self, node):
+        value = node.tok.value
+        return lambda env: value
+
+    def compile_IdentifierNode(self, node):
+        var_name = node.tok.value
+
+        if var_name in self.arg_names and var_name not in self.loop_names:
+            index = self.arg_names.index(var_name)
+            return lambda env: env.args[index]
+
+        def load_name(env):
+            value = env.symbol_table.get(var_name)
+            if value is None:
+                value = BUILTINS.get(var_name)
+                if value is None:
+                    raise RTException(RTError(
+                        node.pos_start, node.pos_end,
+                        f"'{var_name}' is not defined",
+                        env.get_context()
+                    ))
+            return value
+        return load_name
+
+    def compile_BinOpNode(self, node):
+        left = self.compile(node.left_node)
+        right = self.compile(node.right_node)
+
+        if node.op_tok.type == T_DIV:
+            def div(env):
+                left_value = left(env)
+                right_value = right(env)
+                if right_value == 0:
+                    raise RTException(division_by_zero_error(node))
+                return left_value // right_value
+            return div
+
+        return CLOSURE_BINARY_OPS[node.op_tok.type](left, right)
+
+    def compile_UnaryOpNode(self, node):
+        operand = self.compile(node.node)
+
+        if node.op_tok.type == T_NOT:
+            return lambda env: not operand(env)
+        elif node.op_tok.type == T_SUB:
+            return lambda env: -operand(env)
+        return operand
+
+    def compile_IfNode(self, node):
+        cases = [(self.compile(condition), self.compile(expr)) for condition, expr in node.cases]
+        else_case = self.compile(node.else_case) if node.else_case else (lambda env: None)
+
+        if len(cases) == 1:
+            condition, expr = cases[0]
+            return lambda env: expr(env) if condition(env) else else_case(env)
+
+        def if_(env):
+            for condition, expr in cases:
+                if condition(env):
+                    return expr(env)
+            return else_case(env)
+        return if_
+
+    def compile_ForNode(self, node):
+        start_value_node = self.compile(node.start_value_node)
+        end_value_node = self.compile(node.end_value_node)
+        step_value_node = self.compile(node.step_value_node) if node.step_value_node else (lambda env: 1)
+
+        var_name = node.var_name_tok.value if node.var_name_tok else None
+        if var_name: self.loop_names.append(var_name)
+        body = self.compile(node.body_node)
+        if var_name: self.loop_names.pop()
+
+        def for_(env):
+            start_value = start_value_node(env)
+            end_value = end_value_node(env)
+            step_value = step_value_node(env)
+
+            if var_name:
+                symbols = {}
+                body_env = ClosureFrame(env.args, SymbolTable(env.scope(), symbols), env.function, env.context,
+                                        env.depth)
+            else:
+                body_env = env
+            write = current_session().loop_output.write
+            last_value = None
+
+            for current_value in loop_values(start_value, end_value, step_value):
+                if cancelled_sessions: check_cancelled()
+                if var_name:
+                    symbols[var_name] = current_value
+                last_value = body(body_env)
+                write(last_value)
+
+            return last_value
+        return for_
+
+    def compile_FunctionDefNode(self, node):
+        func_name = node.name_tok.value
+        arg_names = [arg_tok.value for arg_tok in node.arg_name_toks]
+        body = ClosureCompiler(arg_names).compile(node.body_node)
+
+        def define(env):
+            func_value = Function(func_name, node.body_node, arg_names, env.get_context(), env.symbol_table)
+            func_value.closure = body
+            define_function(env.symbol_table, func_value)
+            return f"Function '{func_name}' defined successfully"
+        return define
+
+    def compile_LambdaNode(self, node):
+        func_name = f"<anonymous_{id(node)}>"
+        arg_names = [arg_tok.value for arg_tok in node.arg_name_toks]
+        body = ClosureCompiler(arg_names).compile(node.body_node)
+
+        def make_lambda(env):
+            func_value = Function(func_name, node.body_node, arg_names, env.get_context(), env.scope())
+            func_value.closure = body
+            return func_value
+        return make_lambda
+
+    def compile_FunctionCallNode(self, node):
+        callee = node.name_tok
+        arg_nodes = [self.compile(arg_node) for arg_node in node.arg_nodes]
+
+        if isinstance(callee, IdentifierNode):
+            func_name = callee.tok.value
+
+            if func_name in self.arg_names and func_name not in self.loop_names:
+                index = self.arg_names.index(func_name)
+                load_callee = lambda env: env.args[index]
+            else:
+                load_callee = lambda env: env.symbol_table.get(func_name)
+        else:
+            func_name = '<anonymous>'
+            load_callee = self.compile(callee)
+
+        def undefined_callee(env, func_value):
+            # Names that are not defined may still be builtins
+            builtin = BUILTINS.get(func_name) if func_value is None else None
+            if builtin is None:
+                raise RTException(RTError(
+                    node.pos_start, node.pos_end,
+                    f"'{func_name}'  is not defined",
+                    env.get_context()
+                ))
+            return builtin
+
+        def call_builtin(env, builtin, args):
+            try:
+                return builtin.call(args)
+            except BuiltinError as exception:
+                raise RTException(RTError(node.pos_start, node.pos_end, str(exception), env.get_context()))
+
+        def call(env):
+            func_value = load_callee(env)
+            if not func_value:
+                func_value = undefined_callee(env, func_value)
+            args = [arg_node(env) for arg_node in arg_nodes]
+            if type(func_value) is Builtin:
+                return call_builtin(env, func_value, args)
+            return call_closure_function(func_value, args, env.depth)
+
+        if node.is_tail:
+            def tail_call(env):
+                func_value = load_callee(env)
+                if not func_value:
+                    func_value = undefined_callee(env, func_value)
+                args = [arg_node(env) for arg_node in arg_nodes]
+                if type(func_value) is Builtin:
+                    return call_builtin(env, func_value, args)
+                return TailCall(func_value, args)
+            return tail_call
+        return call
+
+
+def run_closure(node, symbol_table, context=None):
+    closure = ClosureCompiler().compile(node)
+    frame = ClosureFrame([], symbol_table, context=context or Context('<program>'))
+
+    try:
+        return closure(frame), None
+    except RTException as exception:
+        return None, exception.error
+
+
+#######################################
+# RAISING INTERPRETER
+#######################################
+
+def call_function(func_value, args, interpreter_class=None, depth=0):
+    if depth >= MAX_NESTED_CALLS:
+        value, error = VM(func_value.symbol_table).call(func_value, args)
+        if error: raise RTException(error)
+        return value
+
+    interpreter_class = interpreter_class or RaisingInterpreter
+    memo = func_value.memo if func_value.memo_deps is not None else func_value.get_memo()
+    if memo is not None:
+        key = make_memo_key(args)
+        value = memo.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+    # Tail calls come back as TailCall values and are run by this loop
+    while True:
+        if cancelled_sessions: check_cancelled()
+        if len(args) != len(func_value.arg_names):
+            raise RTException(RTError(
+                func_value.body_node.pos_start, func_value.body_node.pos_end,
+                f"{len(func_value.arg_names)} arguments expected, got {len(args)}",
+                func_value.parent_context
+            ))
+
+        symbol_table = SymbolTable(func_value.symbol_table, dict(zip(func_value.arg_names, args)))
+        value = interpreter_class(symbol_table, None, func_value, depth + 1).visit(func_value.body_node)
+
+        if type(value) is not TailCall:
+            if memo is not None:
+                memo.put(key, value)
+            return value
+        func_value, args = value.function, value.args
+
+
+class RaisingInterpreter:
+    """Walks the tree like Interpreter, but visitors return plain values and
+    runtime errors are raised as RTException instead of being threaded
+    through an RTResult after every child."""
+
+    __slots__ = ('symbol_table', 'context', 'function', 'depth')
+
+    def __init__(self, symbol_table, context=None, function=None, depth=0):
+        self.symbol_table = symbol_table
+        self.context = context
+        self.function = function
+        # Function calls this one is running inside of (see MAX_NESTED_CALLS)
+        self.depth = depth
+
+    def get_context(self):
+        # A function call only needs its Context for errors and for the
+        # functions it defines, so it is created on first use.
+        if self.context is None:
+            self.context = Context(self.function.name, self.function.parent_context)
+        return self.context
+
+    def visit(self, node):
+        method_name = f'visit_{type(node).__name__}'
+        method = getattr(self, method_name, self.no_visit_method)
+        return method(node)
+
+    def no_visit_method(self, node):
+        raise Exception(f'No visit_{type(node).__name__} method')
+
+    def visit_FunctionDefNode(self, node):
+        func_name = node.name_tok.value
+        arg_names = [arg_tok.value for arg_tok in node.arg_name_toks]
+        func_value = Function(func_name, node.body_node, arg_names, self.get_context(), self.symbol_table)
+
+        define_function(self.symbol_table, func_value)
+        return f"Function '{func_name}' defined successfully"
+
+    def visit_FunctionCallNode(self, node):
+        if type(node.name_tok) is IdentifierNode:
+            func_value = self.symbol_table.get(node.name_tok.tok.value)
+        else:
+            func_value = self.visit(node.name_tok)
+
+        if func_value is None and type(node.name_tok) is IdentifierNode:
+            func_value = BUILTINS.get(node.name_tok.tok.value)
+
+        if not func_value:
+            raise RTException(RTError(
+                node.pos_start, node.pos_end,
+                f"'{node.name_tok.tok.value if isinstance(node.name_tok, IdentifierNode) else '<anonymous>'}'  is not defined",
+                self.get_context()
+            ))
+
+        args = [self.visit(arg_node) for arg_node in node.arg_nodes]
+
+        if type(func_value) is Builtin:
+            try:
+                return func_value.call(args)
+            except BuiltinError as exception:
+                raise RTException(RTError(node.pos_start, node.pos_end, str(exception), self.get_context()))
+
+        if node.is_tail:
+            return TailCall(func_value, args)
+        return call_function(func_value, args, type(self), self.depth)
+
+    def visit_IdentifierNode(self, node):
+        value = self.symbol_table.get(node.tok.value)
+
+        if value is None:
+            value = BUILTINS.get(node.tok.value)
+            if value is None:
+                raise RTException(RTError(
+                    node.pos_start, node.pos_end,
+                    f"'{node.tok.value}' is not defined",
+                    self.get_context()
+                ))
+
+        return value
+
+    def visit_NumberNode(self, node):
+        return node.tok.value
+
+    def visit_BooleanNode(self, node):
+        return node.tok.value
+
+    def visit_BinOpNode(self, node):
+        left = self.visit(node.left_node)
+        right = self.visit(node.right_node)
+
+        try:
+            return node.op_func(left, right)
+        except ZeroDivisionError:
+            if node.op_tok.type != T_DIV: raise
+        except TypeError:
+            # Still a division by zero when the left operand isn't a number
+            if node.op_tok.type != T_DIV or right != 0: raise
+        raise RTException(division_by_zero_error(node))
+
+    def visit_UnaryOpNode(self, node):
+        value = self.visit(node.node)
+
+        if node.op_tok.type == T_NOT:
+            return not value
+        elif node.op_tok.type == T_SUB:
+            return -value
+        return value
+
+    def visit_IfNode(self, node):
+        for condition, expr in node.cases:
+            if self.visit(condition):
+                return self.visit(expr)
+
+        if node.else_case:
+            return self.visit(node.else_case)
+        return None
+
+    def visit_ForNode(self, node):
+        start_value, end_value, step_value = self.visit_loop_bounds(node)
+        return self.run_loop(node, start_value, end_value, step_value)
+
+    def visit_loop_bounds(self, node):
+        start_value = self.visit(node.start_value_node)
+        end_value = self.visit(node.end_value_node)
+        step_value = self.visit(node.step_value_node) if node.step_value_node else 1
+        return start_value, end_value, step_value
+
+    def run_loop(self, node, start_value, end_value, step_value):
+        if node.var_name_tok:
+            var_name = node.var_name_tok.value
+            symbols = {}
+            body_interpreter = type(self)(SymbolTable(self.symbol_table, symbols), self.context, self.function,
+                                          self.depth)
+        else:
+            var_name = None
+            body_interpreter = self
+        body_node = node.body_node
+        visit_body = getattr(body_interpreter, f'visit_{type(body_node).__name__}', body_interpreter.no_visit_method)
+        write = current_session().loop_output.write
+        last_value = None
+
+        for current_value in loop_values(start_value, end_value, step_value):
+            if cancelled_sessions: check_cancelled()
+            if var_name:
+                symbols[var_name] = current_value
+            last_value = visit_body(body_node)
+            write(last_value)
+
+        return last_value
+
+    def visit_LambdaNode(self, node):
+        func_name = f"<anonymous_{id(node)}>"
+        arg_names = [arg_tok.value for arg_tok in node.arg_name_toks]
+        return Function(func_name, node.body_node, arg_names, self.get_context(), self.symbol_table)
+
+
+def run_raising(node, symbol_table, context=None, interpreter_class=None):
+    interpreter_class = interpreter_class or RaisingInterpreter
+    interpreter = interpreter_class(symbol_table, context or Context('<program>'))
+
+    # Errors raised anywhere below are turned back into the (value, error)
+    # pair the other engines return.
+    try:
+        return interpreter.visit(node), None
+    except RTException as exception:
+        return None, exception.error
+
+
+#######################################
+# VECTORIZED LOOPS
+#######################################
+
+# Shorter loops are not worth setting up arrays for
+VECTOR_MIN_ITERATIONS = 32
+
+# Every intermediate value is kept below this magnitude, so checking operand
+# bounds before an operation rules out int64 overflow; anything larger runs
+# on Python's arbitrary-precision ints instead.
+VECTOR_INT_LIMIT = 2 ** 62
+
+VECTOR_COMPARISONS = {
+    T_EQEQ: operator.eq,
+    T_NOTEQUAL: operator.ne,
+    T_GREATERTHAN: operator.gt,
+    T_LESSTHAN: operator.lt,
+    T_EQGREATERTHAN: operator.ge,
+    T_EQLESSTHAN: operator.le,
+}
+
+
+class CannotVectorize(Exception):
+    """The loop can't be run as array operations with identical results."""
+
+
+def is_vectorizable(node):
+    if isinstance(node, (NumberNode, BooleanNode, IdentifierNode)):
+        return True
+    elif isinstance(node, BinOpNode):
+        return is_vectorizable(node.left_node) and is_vectorizable(node.right_node)
+    elif isinstance(node, UnaryOpNode):
+        return is_vectorizable(node.node)
+    elif isinstance(node, IfNode):
+        return (all(is_vectorizable(condition) and is_vectorizable(expr) for condition, expr in node.cases)
+                and (node.else_case is None or is_vectorizable(node.else_case)))
+    return False
+
+
+class LoopVectorizer:
+    """Evaluates a loop body for every iteration at once. Values are
+    (array, kind) pairs where kind is 'int' or 'bool', since Python prints
+    True and 1 differently. Each node is evaluated under a mask of the
+    iterations that actually reach it, so IF branches and divisions only
+    answer for the iterations that would run them."""
+
+    def __init__(self, var_name, symbol_table, counter):
+        self.var_name = var_name
+        self.symbol_table = symbol_table
+        self.counter = counter
+
+    def evaluate(self, node, mask):
+        method_name = f'evaluate_{type(node).__name__}'
+        return getattr(self, method_name)(node, mask)
+
+    def evaluate_NumberNode(self, node, mask):
+        return self.constant(node.tok.value)
+
+    def evaluate_BooleanNode(self, node, mask):
+        return self.constant(node.tok.value)
+
+    def evaluate_IdentifierNode(self, node, mask):
+        if node.tok.value == self.var_name:
+            return self.counter, 'int'
+        # Names from outside the loop can't change while a body without calls runs
+        return self.constant(self.symbol_table.get(node.tok.value))
+
+    def constant(self, value):
+        if type(value) is bool:
+            return np.bool_(value), 'bool'
+        if type(value) is int and abs(value) < VECTOR_INT_LIMIT:
+            return np.int64(value), 'int'
+        raise CannotVectorize()
+
+    def evaluate_UnaryOpNode(self, node, mask):
+        value, kind = self.evaluate(node.node, mask)
+
+        if node.op_tok.type == T_NOT:
+            return np.logical_not(value) if kind == 'bool' else value == 0, 'bool'
+        elif node.op_tok.type == T_SUB:
+            return -as_int64(value), 'int'
+        return value, kind
+
+    def evaluate_BinOpNode(self, node, mask):
+        left, left_kind = self.evaluate(node.left_node, mask)
+        right, right_kind = self.evaluate(node.right_node, mask)
+        op = node.op_tok.type
+
+        if op == T_AND:
+            return self.select(mask, truth(left, left_kind), (right, right_kind), (left, left_kind))
+        elif op == T_OR:
+            return self.select(mask, truth(left, left_kind), (left, left_kind), (right, right_kind))
+
+        left = as_int64(left)
+        right = as_int64(right)
+
+        if op in VECTOR_COMPARISONS:
+            return VECTOR_COMPARISONS[op](left, right), 'bool'
+
+        left_bound = magnitude(left)
+        right_bound = magnitude(right)
+
+        if op == T_PLUS or op == T_SUB:
+            if left_bound + right_bound >= VECTOR_INT_LIMIT:
+                raise CannotVectorize()
+            return (left + right if op == T_PLUS else left - right), 'int'
+        elif op == T_MUL:
+            if left_bound * right_bound >= VECTOR_INT_LIMIT:
+                raise CannotVectorize()
+            return left * right, 'int'
+
+        # Division and modulo: an iteration that divides by zero has to fail
+        # in order, after the output of the iterations before it.
+        if np.any(mask & (right == 0)):
+            raise CannotVectorize()
+        right = np.where(right == 0, 1, right)
+        if op == T_DIV:
+            return np.floor_divide(left, right), 'int'
+        return np.remainder(left, right), 'int'
+
+    def evaluate_IfNode(self, node, mask):
+        remaining = mask
+        branches = []
+
+        for condition, expr in node.cases:
+            condition_value, condition_kind = self.evaluate(condition, remaining)
+            condition_truth = truth(condition_value, condition_kind)
+            taken = remaining & condition_truth
+            branches.append((taken, self.evaluate(expr, taken)))
+            remaining = remaining & ~condition_truth
+
+        if node.else_case:
+            branches.append((remaining, self.evaluate(node.else_case, remaining)))
+        elif np.any(remaining):
+            # Those iterations would produce None
+            raise CannotVectorize()
+
+        result, result_kind = np.int64(0), None
+        for taken, (value, kind) in branches:
+            if not np.any(taken):
+                continue
+            if result_kind is not None and kind != result_kind:
+                raise CannotVectorize()
+            result = np.where(taken, value, result) if result_kind else value
+            result_kind = kind
+        return result, result_kind
+
+    def select(self, mask, condition, when_true, when_false):
+        # np.where over two values, as long as every iteration still running
+        # ends up with a value of the same kind
+        (true_value, true_kind), (false_value, false_kind) = when_true, when_false
+        if true_kind != false_kind:
+            if not np.any(mask & ~condition):
+                return true_value, true_kind
+            if not np.any(mask & condition):
+                return false_value, false_kind
+            raise CannotVectorize()
+        return np.where(condition, true_value, false_value), true_kind
+
+
+def as_int64(value):
+    return value.astype(np.int64) if value.dtype == np.bool_ else value
+
+
+def truth(value, kind):
+    return value if kind == 'bool' else value != 0
+
+
+def magnitude(value):
+    return int(np.max(np.abs(value)))
+
+
+def vectorize_loop(node, start_value, end_value, step_value, symbol_table):
+    """Returns the value of every iteration as a list, or raises
+    CannotVectorize when the scalar loop has to run instead."""
+    values = loop_values(start_value, end_value, step_value)
+    if (type(values) is not range or len(values) < VECTOR_MIN_ITERATIONS
+            or max(abs(start_value), abs(end_value), step_value) >= VECTOR_INT_LIMIT):
+        raise CannotVectorize()
+
+    counter = np.arange(values.start, values.stop, values.step, dtype=np.int64)
+    var_name = node.var_name_tok.value if node.var_name_tok else None
+    vectorizer = LoopVectorizer(var_name, symbol_table, counter)
+
+    result, kind = vectorizer.evaluate(node.body_node, np.ones(len(counter), dtype=np.bool_))
+    return np.broadcast_to(result, counter.shape).tolist()
+
+
+class VectorInterpreter(RaisingInterpreter):
+    """RaisingInterpreter that runs FOR loops whose bodies are plain
+    arithmetic, comparisons and IFs as NumPy array operations, and every
+    other loop the scalar way."""
+
+    __slots__ = ()
+
+    def visit_ForNode(self, node):
+        start_value, end_value, step_value = self.visit_loop_bounds(node)
+
+        if np is not None and is_vectorizable(node.body_node):
+            try:
+                values = vectorize_loop(node, start_value, end_value, step_value, self.symbol_table)
+            except CannotVectorize:
+                pass
+            else:
+                write = current_session().loop_output.write
+                for value in values:
+                    write(value)
+                return values[-1]
+
+        return self.run_loop(node, start_value, end_value, step_value)
+
+
+#######################################
+# SAMPLING PROFILER
+#######################################
+
+class SamplingProfiler:
+    """Samples the language-level call stack of a thread from a background
+    thread, every interval seconds, while it is active:
+
+        with SamplingProfiler() as sampler:
+            run('<stdin>', 'fibonacci(25)')
+        print(sampler.collapsed())
+
+    Each sample walks the thread's Python frames and keeps the functions
+    that the engines are running: the func of Function.execute, call_function
+    and call_closure_function frames, and the frame list of the VM. The Context
+    chain can't be used for this, because a Context's parent is the context
+    the function was defined in, not its caller. Nothing is added to the
+    evaluation itself, so any engine can be sampled at full speed."""
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        # Stack of function names, outermost first -> [samples, seconds]
+        self.stacks = {}
+        self.sample_count = 0
+        self.thread_id = None
+        self.stop_event = threading.Event()
+        self.sampler_thread = None
+        self.function_locals = {
+            Function.execute.__code__: 'func',
+            call_function.__code__: 'func_value',
+            call_closure_function.__code__: 'func_value',
+        }
+        self.root_codes = {Session.execute.__code__, Profiler.run.__code__}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self, thread=None):
+        thread = thread or threading.current_thread()
+        self.thread_id = thread.ident
+        self.stop_event.clear()
+        self.sampler_thread = threading.Thread(target=self.sample_loop, name='SamplingProfiler', daemon=True)
+        self.sampler_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.sampler_thread.join()
+
+    def sample_loop(self):
+        last_sample = time.perf_counter()
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            elapsed, last_sample = now - last_sample, now
+
+            stack = self.language_stack(frame) if frame is not None else None
+            # The thread isn't evaluating anything right now
+            if not stack: continue
+
+            self.sample_count += 1
+            counts = self.stacks.get(stack)
+            if counts is None:
+                counts = self.stacks[stack] = [0, 0.0]
+            counts[0] += 1
+            counts[1] += elapsed
+
+    def language_stack(self, frame):
+        names = []
+        in_program = False
+        while frame is not None:
+            code = frame.f_code
+            # A frame can be sampled before it has bound the local that
+            # holds the running function
+            if code in self.function_locals:
+                func = frame.f_locals.get(self.function_locals[code])
+                if func is not None:
+                    names.append(func.name)
+            elif code is VM.run.__code__:
+                vm_locals = frame.f_locals
+                current = [vm_locals.get('func')] + [saved_frame[4] for saved_frame in reversed(vm_locals.get('frames', ()))]
+                names.extend(func.name for func in current if func is not None)
+            elif code in self.root_codes:
+                in_program = True
+            frame = frame.f_back
+
+        if not in_program:
+            return None
+        names.append('<program>')
+        return tuple(reversed(names))
+
+    def collapsed(self):
+        """Folded stacks, one 'outer;inner count' line per distinct stack,
+        as read by flamegraph.pl and most flame graph viewers."""
+        return ''.join(f"{';'.join(stack)} {samples}\n"
+                       for stack, (samples, seconds) in sorted(self.stacks.items()))
+
+    def speedscope(self, name='ProjectPartA'):
+        """The samples as a speedscope (https://www.speedscope.app) file,
+        weighted by the time between samples."""
+        frame_indexes = {}
+        samples = []
+        weights = []
+        for stack, (count, seconds) in sorted(self.stacks.items()):
+            samples.append([frame_indexes.setdefault(frame_name, len(frame_indexes)) for frame_name in stack])
+            weights.append(seconds)
+
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'ProjectPartA.SamplingProfiler',
+            'shared': {'frames': [{'name': frame_name} for frame_name in frame_indexes]},
+            'profiles': [{
+                'type': 'sampled',
+                'name': name,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': samples,
+                'weights': weights,
+            }],
+        }
+
+
+#######################################
+# PROGRAM CACHE AND SNAPSHOTS
+#######################################
+
+# Program cache files and session snapshots hold the magic number, the
+# SHA-256 digest of the rest of the file, and then two zlib-compressed
+# pickles: a key, and the data. The digest catches truncated or corrupted
+# files before they are unpickled, and the key is checked before the data is
+# unpickled, so a stale file never builds objects from classes that have
+# changed since. Syntax trees pickle to very repetitive data, so compression
+# makes the files many times smaller for a few milliseconds per megabyte.
+PROGRAM_CACHE_SUFFIX = '.astcache'
+PROGRAM_CACHE_MAGIC = b'PPAC\x03\n'
+SNAPSHOT_MAGIC = b'PPSS\x01\n'
+_interpreter_version = None
+
+
+def interpreter_version():
+    # Any change to this file may change the syntax trees it builds
+    global _interpreter_version
+    if _interpreter_version is None:
+        with open(__file__, 'rb') as file:
+            _interpreter_version = hashlib.sha256(file.read()).hexdigest()
+    return sys.version_info[:2], _interpreter_version
+
+
+def read_checked_file(path, magic, key):
+    """Returns the data stored by write_checked_file() under key, or None if
+    the file is damaged or was written with a different key."""
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    header_size = len(magic) + 32
+    if not data.startswith(magic) or len(data) < header_size:
+        return None
+    payload = data[header_size:]
+    if hashlib.sha256(payload).digest() != data[len(magic):header_size]:
+        return None
+
+    try:
+        stream = io.BytesIO(zlib.decompress(payload))
+        if pickle.load(stream) != key:
+            return None
+        return pickle.load(stream)
+    except Exception:
+        return None
+
+
+def write_checked_file(path, magic, key, value):
+    payload = zlib.compress(pickle.dumps(key, pickle.HIGHEST_PROTOCOL) + pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, 'wb') as file:
+            file.write(magic + hashlib.sha256(payload).digest() + payload)
+        # Replaced in one step, so concurrent readers never see half a file
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def program_cache_key(path, text, optimize):
+    # The path is part of the key because positions in the tree refer to it
+    return (interpreter_version(), path, optimize, hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest())
+
+
+def read_program_cache(cache_path, key):
+    try:
+        return read_checked_file(cache_path, PROGRAM_CACHE_MAGIC, key)
+    except OSError:
+        return None
+
+
+def write_program_cache(cache_path, key, statements):
+    # Best effort: a program whose cache can't be written still runs
+    try:
+        write_checked_file(cache_path, PROGRAM_CACHE_MAGIC, key, statements)
+    except (OSError, RecursionError):
+        pass
+
+
+#######################################
+# RUN
+#######################################
+
+ENGINES = ('interpreter', 'raising', 'numpy', 'vm', 'closure')
+
+# The session each thread is running a statement for, if any
+thread_state = threading.local()
+
+# Sessions whose running statement has been cancelled. The engines only look
+# up the current session when this isn't empty, so checking costs next to
+# nothing while nothing is cancelled.
+cancelled_sessions = set()
+cancel_lock = threading.Lock()
+
+
+class Session:
+    """Everything a run changes or depends on: the symbol table holding the
+    functions defined so far, the parse cache, the memo cache size and where
+    FOR loop output goes. Sessions share no mutable state, so separate
+    sessions can run in different threads at the same time; each session
+    runs one statement at a time. The module-level run(), parse() and
+    friends use default_session."""
+
+    def __init__(self, parse_cache_size=512, memo_cache_size=1024, symbol_table=None):
+        self.symbol_table = SymbolTable() if symbol_table is None else symbol_table
+        # Parsed (and optimized) trees by source text. Failures are cached
+        # too, so a repeated bad input returns the very same Error object.
+        self.parse_cache = LRUCache(parse_cache_size)
+        self.memo_cache_size = memo_cache_size
+        self.loop_output = OutputSink()
+        self.lock = threading.RLock()
+        # Statements running, counting nested execute() calls
+        self.running = 0
+
+    def set_loop_output(self, sink):
+        """Sets where FOR loops send the value of each iteration: an object
+        with write(value) and flush(), or None to discard it."""
+        self.loop_output = DiscardOutput() if sink is None else sink
+
+    def set_parse_cache_size(self, maxsize):
+        with self.lock:
+            self.parse_cache.resize(maxsize)
+
+    def parse_cache_stats(self):
+        return self.parse_cache.stats()
+
+    def memo_stats(self):
+        return memo_stats(self.symbol_table)
+
+    def parse(self, fn, text, optimize=True, lexer='reference', first_line=0):
+        with self.lock:
+            key = (fn, text, optimize, first_line)
+            entry = self.parse_cache.get(key, _MISSING)
+            if entry is _MISSING:
+                entry = parse_source(fn, text, optimize, lexer, first_line)
+                self.parse_cache.put(key, entry)
+            return entry
+
+    def run(self, fn, text, engine='interpreter', optimize=True, lexer='reference', profiler=None):
+        check_run_options(engine, lexer)
+
+        with self.lock:
+            if profiler is not None:
+                if engine != 'interpreter':
+                    raise ValueError(f"Profiling is only supported on the 'interpreter' engine, not '{engine}'")
+                return self.execute(profiler.run, self, fn, text, optimize, lexer)
+
+            node, error = self.parse(fn, text, optimize, lexer)
+            if error: return None, error
+
+            return self.execute(execute_engine, node, engine, self.symbol_table)
+
+    def parse_program(self, fn, lines, optimize=True, lexer='reference'):
+        # Yields (node, error) for each statement, up to the first error
+        if isinstance(lines, str):
+            lines = lines.splitlines()
+
+        for line_number, line in enumerate(lines):
+            text = line.rstrip('\r\n')
+            if not text.strip():
+                continue
+
+            node, error = self.parse(fn, text, optimize, lexer, first_line=line_number)
+            yield node, error
+            if error: return
+
+    def run_program(self, fn, lines, engine='interpreter', optimize=True, lexer='reference'):
+        """Runs a program with one statement per line, yielding (value, error)
+        for each statement as it runs. Blank lines are skipped and the program
+        stops after the first error. lines may be a string or any iterable of
+        lines, such as an open file, which is then read one line at a time."""
+        check_run_options(engine, lexer)
+        yield from self.run_statements(self.parse_program(fn, lines, optimize, lexer), engine)
+
+    def run_statements(self, statements, engine):
+        for node, error in statements:
+            if error:
+                yield None, error
+                return
+
+            value, error = self.execute(execute_engine, node, engine, self.symbol_table)
+            yield value, error
+            if error: return
+
+    def run_file(self, path, engine='interpreter', optimize=True, lexer='reference', cache=False):
+        """Runs the program in a file like run_program(). With cache=True the
+        parsed program is kept in a cache file next to it, and later runs of
+        the unchanged file skip lexing and parsing."""
+        check_run_options(engine, lexer)
+
+        if cache:
+            yield from self.run_statements(self.load_program(path, optimize, lexer), engine)
+            return
+
+        with open(path) as file:
+            yield from self.run_program(path, file, engine, optimize, lexer)
+
+    def load_program(self, path, optimize=True, lexer='reference'):
+        with open(path) as file:
+            text = file.read()
+
+        cache_path = path + PROGRAM_CACHE_SUFFIX
+        key = program_cache_key(path, text, optimize)
+        statements = read_program_cache(cache_path, key)
+        if statements is None:
+            # Read like a file, one line per newline
+            statements = list(self.parse_program(path, io.StringIO(text), optimize, lexer))
+            write_program_cache(cache_path, key, statements)
+        return statements
+
+    def run_many(self, expressions, workers=None, engine='interpreter', optimize=True, lexer='reference',
+                 fn='<batch>', chunksize=None):
+        """Evaluates independent expressions in a pool of worker processes and
+        returns their (value, error) pairs in order. Every worker starts with a
+        copy of the functions defined so far, sent once when it starts; anything
+        the expressions define only lasts in the worker that ran it, and FOR loop
+        output is discarded."""
+        check_run_options(engine, lexer)
+        expressions = list(expressions)
+        workers = workers or os.cpu_count() or 1
+        # A few chunks per worker, so one slow chunk doesn't hold up the batch
+        chunksize = chunksize or max(1, len(expressions) // (workers * 4))
+
+        with self.lock:
+            initargs = (self.symbol_table, self.memo_cache_size)
+            with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+                return pool.map(partial(_run_in_worker, fn, engine=engine, optimize=optimize, lexer=lexer),
+                                expressions, chunksize)
+
+    def save_snapshot(self, path):
+        """Saves the functions defined so far, with everything they capture,
+        so that Session.load_snapshot() can restore them without running the
+        definitions again."""
+        with self.lock:
+            write_checked_file(path, SNAPSHOT_MAGIC, interpreter_version(), (self.symbol_table, self.memo_cache_size))
+
+    @classmethod
+    def load_snapshot(cls, path, parse_cache_size=512):
+        # A snapshot is read in one go and can only be restored by the same
+        # interpreter version that saved it
+        state = read_checked_file(path, SNAPSHOT_MAGIC, interpreter_version())
+        if state is None:
+            raise ValueError(f"'{path}' is not a session snapshot saved by this interpreter version, or is damaged")
+        symbol_table, memo_cache_size = state
+        return cls(parse_cache_size, memo_cache_size, symbol_table)
+
+    def cancel(self):
+        """Stops the statement this session is running, from any thread. The
+        engines stop at the next function call or loop iteration, and the
+        statement fails with an "Evaluation cancelled" error; work inside a
+        single operation, such as multiplying huge numbers or a vectorized
+        loop, is finished first. Returns False if no statement was running."""
+        with cancel_lock:
+            if not self.running:
+                return False
+            cancelled_sessions.add(self)
+            return True
+
+    def execute(self, function, *args):
+        # Runs function as this thread's current session. FOR loop output is
+        # buffered until the statement is done.
+        with self.lock:
+            previous = getattr(thread_state, 'session', None)
+            thread_state.session = self
+            with cancel_lock:
+                self.running += 1
+            try:
+                return function(*args)
+            finally:
+                with cancel_lock:
+                    self.running -= 1
+                    if not self.running:
+                        cancelled_sessions.discard(self)
+                thread_state.session = previous
+                self.loop_output.flush()
+
+
+def current_session():
+    return getattr(thread_state, 'session', None) or default_session
+
+
+def check_cancelled():
+    if current_session() in cancelled_sessions:
+        raise EvaluationCancelled()
+
+
+default_session = Session()
+
+
+def set_loop_output(sink):
+    default_session.set_loop_output(sink)
+
+
+def set_parse_cache_size(maxsize):
+    default_session.set_parse_cache_size(maxsize)
+
+
+def parse_cache_stats():
+    return default_session.parse_cache_stats()
+
+
+def parse(fn, text, optimize=True, lexer='reference', first_line=0):
+    return default_session.parse(fn, text, optimize, lexer, first_line)
+
+
+def parse_source(fn, text, optimize=True, lexer='reference', first_line=0):
+    # Lexing and parsing, with the parser pulling tokens as it needs them
+    lexer = LEXERS[lexer](fn, text, first_line)
+
+    try:
+        parser = Parser(lexer.generate_tokens())
+        ast = parser.parse()
+        # A lexing error anywhere in the text takes precedence over the
+        # parse result, as it did when the whole text was lexed up front.
+        for tok in parser.tokens:
+            pass
+        if ast.error:
+            return None, ast.error
+        return Optimizer().optimize(ast.node) if optimize else ast.node, None
+    except LexerException as exception:
+        return None, exception.error
+    except RecursionError:
+        source = Source(fn, text, first_line)
+        return None, InvalidSyntaxError(Position(0, source), Position(len(text), source),
+                                        "Expression is nested too deeply")
+
+
+def check_run_options(engine, lexer):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of {ENGINES}")
+    if lexer not in LEXERS:
+        raise ValueError(f"Unknown lexer '{lexer}', expected one of {tuple(LEXERS)}")
+
+
+def run(fn, text, engine='interpreter', optimize=True, lexer='reference', profiler=None):
+    return default_session.run(fn, text, engine, optimize, lexer, profiler)
+
+
+def run_program(fn, lines, engine='interpreter', optimize=True, lexer='reference'):
+    return default_session.run_program(fn, lines, engine, optimize, lexer)
+
+
+def run_file(path, engine='interpreter', optimize=True, lexer='reference', cache=False):
+    return default_session.run_file(path, engine, optimize, lexer, cache)
+
+
+def run_many(expressions, workers=None, engine='interpreter', optimize=True, lexer='reference',
+             fn='<batch>', chunksize=None):
+    return default_session.run_many(expressions, workers, engine, optimize, lexer, fn, chunksize)
+
+
+def _init_worker(symbol_table, memo_cache_size):
+    global default_session
+    default_session = Session(memo_cache_size=memo_cache_size, symbol_table=symbol_table)
+    default_session.set_loop_output(None)
+
+
+def _run_in_worker(fn, text, engine, optimize, lexer):
+    return run(fn, text, engine, optimize, lexer)
+
+
+def execute(node, engine):
+    return default_session.execute(execute_engine, node, engine, default_session.symbol_table)
+
+
+def execute_engine(node, engine, symbol_table):
+    try:
+        return run_engine(node, engine, symbol_table)
+    except RecursionError:
+        # Deeply nested expressions can still run out of Python stack
+        return None, statement_error(node, "Maximum recursion depth exceeded")
+    except EvaluationCancelled:
+        return None, statement_error(node, "Evaluation cancelled")
+
+
+def statement_error(node, details):
+    # An error that stopped the statement as a whole
+    return RTError(node.pos_start, node.pos_end, details, Context('<program>'))
+
+
+def run_engine(node, engine, symbol_table):
+    # Compiling and running on the virtual machine
+    if engine == 'vm':
+        code = Compiler().compile_program(node)
+        return VM(symbol_table).run(code)
 
+    # Interpreting with errors raised as exceptions
+    if engine == 'raising':
+        return run_raising(node, symbol_table)
 
-def run(fn, text):
-    # Lexing
-    lexer = my_Lexer(fn, text)
-    tokens, error = lexer.make_tokens()
-    if error: return None, error
+    # Interpreting, with arithmetic FOR loops run as array operations
+    if engine == 'numpy':
+        return run_raising(node, symbol_table, interpreter_class=VectorInterpreter)
 
-    # Parsing
-    parser = Parser(tokens)
-    ast = parser.parse()
-    if ast.error: return None, ast.error
+    # Compiling to closures
+    if engine == 'closure':
+        return run_closure(node, symbol_table)
 
     # Interpreting
-    interpreter = Interpreter(global_symbol_table)
-    result = interpreter.visit(ast.node)
+    interpreter = Interpreter(symbol_table)
+    result = interpreter.visit(node)
 
     return result.value, result.error
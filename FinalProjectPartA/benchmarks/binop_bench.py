@@ -0,0 +1,103 @@
+"""Time per binary operation on deep arithmetic and logical expressions.
+
+Run from the FinalProjectPartA directory:
+
+    python -m benchmarks.binop_bench [--depth N] [--engine E ...] [ProjectPartA.py ...]
+
+Each expression is a left-deep chain of one operator, e.g. `7 * 3 * 3 * ...`,
+parsed once without the optimizer (which would fold it to a constant) and
+then executed repeatedly. Comparisons are chained over booleans, so every
+operation in the chain sees two operands of the same type; the 'mixed' rows
+chain them over ints, where every step after the first compares a bool with
+an int. As in memory_bench, several modules can be given to compare builds.
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+DEFAULT_MODULE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ProjectPartA.py')
+
+# (operator, operand kind, first operand, every other operand)
+CASES = [
+    ('+', 'int', '7', '3'),
+    ('-', 'int', '7', '3'),
+    ('*', 'int', '7', '3'),
+    ('/', 'int', '7', '3'),
+    ('%', 'int', '7', '3'),
+    ('and', 'int', '7', '3'),
+    ('or', 'int', '7', '3'),
+    ('==', 'bool', 'true', 'false'),
+    ('!=', 'bool', 'true', 'false'),
+    ('<', 'bool', 'true', 'false'),
+    ('>', 'bool', 'true', 'false'),
+    ('<=', 'bool', 'true', 'false'),
+    ('>=', 'bool', 'true', 'false'),
+    ('and', 'bool', 'true', 'false'),
+    ('or', 'bool', 'true', 'false'),
+    ('<', 'mixed', '7', '3'),
+    ('==', 'mixed', '7', '3'),
+]
+
+
+def load_module(path, index):
+    spec = importlib.util.spec_from_file_location(f'_binop_bench_{index}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def chain(op, first, operand, depth):
+    return first + f' {op} {operand}' * depth
+
+
+def time_per_op(modules, engine, text, depth, min_time):
+    nodes = []
+    for module in modules:
+        node, error = module.parse('<bench>', text, optimize=False)
+        if error: raise RuntimeError(error.as_string())
+        nodes.append(node)
+
+    # Best of many rounds, taking turns between modules, so that a machine
+    # whose speed drifts doesn't favour whichever module ran first
+    best = [float('inf')] * len(modules)
+    deadline = time.perf_counter() + min_time * len(modules)
+    while time.perf_counter() < deadline:
+        for index, (module, node) in enumerate(zip(modules, nodes)):
+            start = time.perf_counter()
+            result, error = module.execute(node, engine)
+            elapsed = time.perf_counter() - start
+            if error: raise RuntimeError(error.as_string())
+            best[index] = min(best[index], elapsed)
+    return [elapsed / depth * 1e9 for elapsed in best]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('modules', nargs='*', default=[DEFAULT_MODULE],
+                            help='ProjectPartA.py files to measure')
+    arg_parser.add_argument('--depth', type=int, default=200, help='operations per expression')
+    arg_parser.add_argument('--engine', action='append', help='engines to time (default: all)')
+    arg_parser.add_argument('--min-time', type=float, default=0.2, help='seconds spent on each case and module')
+    args = arg_parser.parse_args()
+
+    # The tree walkers recurse once per level of the chain
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), args.depth * 10))
+
+    modules = [load_module(path, index) for index, path in enumerate(args.modules)]
+    engines = args.engine or [engine for engine in modules[0].ENGINES if engine != 'numpy']
+
+    for engine in engines:
+        print(f"engine: {engine} (ns/op)")
+        print(f"{'operator':>8} {'operands':>8}" + ''.join(f" {path[-24:]:>24}" for path in args.modules))
+        for op, kind, first, operand in CASES:
+            text = chain(op, first, operand, args.depth)
+            times = time_per_op(modules, engine, text, args.depth, args.min_time)
+            print(f"{op:>8} {kind:>8}" + ''.join(f" {ns:>24.1f}" for ns in times))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Load generator for the evaluation server.
+
+Run from the FinalProjectPartA directory, with the server started first
+(`python server.py`):
+
+    python -m benchmarks.load_client [--port 8765 | --unix PATH]
+                                     [--connections 16] [--requests 200]
+                                     [--expression 'factorial({i} % 50)']
+
+Every connection first sends the --setup statements, then its requests one
+after another, each waiting for the previous response. {i} in the expression
+is replaced by the request number, so runs are not all served from the parse
+and memoization caches. Reports the throughput and the latency percentiles
+of the timed requests, and exits with status 1 if any of them failed.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+SETUP = [
+    "DEFUN factorial(n) : if n == 0 then 1 else n * factorial(n - 1)",
+    "DEFUN fibonacci(n) : if n <= 1 then n else fibonacci(n - 1) + fibonacci(n - 2)",
+]
+
+
+async def request(reader, writer, message):
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("server closed the connection")
+    return json.loads(line)
+
+
+async def run_connection(args, index, latencies, errors):
+    if args.unix:
+        reader, writer = await asyncio.open_unix_connection(args.unix)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+
+    try:
+        for statement in args.setup or SETUP:
+            response = await request(reader, writer, {'code': statement})
+            if response['error']:
+                errors.append(response['error'])
+
+        for i in range(args.requests):
+            message = {'id': i, 'code': args.expression.format(i=i, connection=index), 'engine': args.engine}
+            start = time.perf_counter()
+            response = await request(reader, writer, message)
+            latencies.append(time.perf_counter() - start)
+            if response['error']:
+                errors.append(response['error'])
+    finally:
+        writer.close()
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def run_load(args):
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_connection(args, index, latencies, errors) for index in range(args.connections)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{len(latencies)} requests over {args.connections} connections in {elapsed:.2f} s")
+    print(f"throughput: {len(latencies) / elapsed:,.0f} requests/s")
+    print(f"latency (ms): mean {statistics.mean(latencies) * 1e3:.2f}"
+          + ''.join(f", p{fraction * 100:g} {percentile(latencies, fraction) * 1e3:.2f}"
+                    for fraction in (0.5, 0.9, 0.99, 0.999))
+          + f", max {latencies[-1] * 1e3:.2f}")
+    if errors:
+        print(f"{len(errors)} errors, e.g. {errors[0]}")
+    return 1 if errors else 0
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--unix', metavar='PATH', help='connect to a Unix socket instead of TCP')
+    arg_parser.add_argument('--connections', type=int, default=16)
+    arg_parser.add_argument('--requests', type=int, default=200, help='timed requests per connection')
+    arg_parser.add_argument('--expression', default='factorial({i} % 50)',
+                            help='code to send; {i} is the request number and {connection} the connection')
+    arg_parser.add_argument('--engine', default='interpreter')
+    arg_parser.add_argument('--setup', action='append', help='statement to run on every connection first'
+                                                             ' (default: define factorial and fibonacci)')
+    args = arg_parser.parse_args()
+
+    raise SystemExit(asyncio.run(run_load(args)))
+
+
+if __name__ == '__main__':
+    main()
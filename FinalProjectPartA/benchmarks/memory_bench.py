@@ -0,0 +1,119 @@
+"""Memory used by tokens and AST nodes on a large generated script.
+
+Run from the FinalProjectPartA directory:
+
+    python -m benchmarks.memory_bench [--statements N] [ProjectPartA.py ...]
+
+Each given interpreter module is measured in turn (default: the one in this
+directory), so an older build can be compared against the current one, e.g.
+after `git show <rev>:FinalProjectPartA/ProjectPartA.py > /tmp/before.py`.
+"""
+
+import argparse
+import gc
+import importlib.util
+import os
+import tracemalloc
+
+DEFAULT_MODULE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ProjectPartA.py')
+
+STATEMENT_TEMPLATES = [
+    "DEFUN fun{name}(a, b) : if a > b then a * {n} else fun{name}(b, a) + {n}",
+    "fun{name}(3, 4) + (lambda x: x * 2)({n})",
+    "if {n} % 3 == 0 then {n} / 3 elseif {n} % 3 == 1 then -{n} else not false",
+    "(lambda x, y: x - y)({n}, 7) * ({n} + 1) >= 10 and true",
+]
+
+# Node attributes that can hold child nodes (name_tok is a node in calls)
+CHILD_ATTRIBUTES = ('left_node', 'right_node', 'node', 'cases', 'else_case', 'name_tok', 'arg_nodes',
+                    'body_node', 'start_value_node', 'end_value_node', 'step_value_node', 'element_nodes')
+
+
+def letters(n):
+    # Identifiers are letters only, so function names spell n in base 26
+    name = ''
+    while True:
+        n, digit = divmod(n, 26)
+        name += chr(ord('a') + digit)
+        if n == 0:
+            return name
+
+
+def generate_script(statement_count):
+    return [STATEMENT_TEMPLATES[n % len(STATEMENT_TEMPLATES)].format(n=n, name=letters(n // len(STATEMENT_TEMPLATES)))
+            for n in range(statement_count)]
+
+
+def load_module(path, index):
+    spec = importlib.util.spec_from_file_location(f'_memory_bench_{index}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def count_nodes(root, module):
+    node_types = tuple(cls for name, cls in vars(module).items()
+                       if isinstance(cls, type) and name.endswith('Node'))
+    count = 0
+    stack = [root]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, node_types):
+            count += 1
+            stack.extend(getattr(value, name, None) for name in CHILD_ATTRIBUTES)
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return count
+
+
+def measure(module, lines):
+    gc.collect()
+    tracemalloc.start()
+
+    base = tracemalloc.get_traced_memory()[0]
+    token_lists = []
+    for line in lines:
+        tokens, error = module.my_Lexer('<bench>', line).make_tokens()
+        if error: raise RuntimeError(error.as_string())
+        token_lists.append(tokens)
+    gc.collect()
+    after_lexing = tracemalloc.get_traced_memory()[0]
+
+    trees = []
+    for tokens in token_lists:
+        result = module.Parser(tokens).parse()
+        if result.error: raise RuntimeError(result.error.as_string())
+        trees.append(result.node)
+    gc.collect()
+    after_parsing = tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.stop()
+
+    token_count = sum(len(tokens) for tokens in token_lists)
+    node_count = sum(count_nodes(tree, module) for tree in trees)
+    return {
+        'tokens': token_count,
+        'nodes': node_count,
+        'bytes_per_token': (after_lexing - base) / token_count,
+        'bytes_per_node': (after_parsing - after_lexing) / node_count,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('modules', nargs='*', default=[DEFAULT_MODULE],
+                            help='ProjectPartA.py files to measure')
+    arg_parser.add_argument('--statements', type=int, default=100_000)
+    args = arg_parser.parse_args()
+
+    lines = generate_script(args.statements)
+    print(f"{args.statements} statements, {sum(map(len, lines))} characters")
+    print(f"{'module':40} {'tokens':>9} {'B/token':>8} {'nodes':>9} {'B/node':>8}")
+    for index, path in enumerate(args.modules):
+        stats = measure(load_module(path, index), lines)
+        print(f"{path[-40:]:40} {stats['tokens']:>9} {stats['bytes_per_token']:>8.1f}"
+              f" {stats['nodes']:>9} {stats['bytes_per_node']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Time to get a session ready with a large prelude of DEFUNs.
+
+Run from the FinalProjectPartA directory:
+
+    python -m benchmarks.startup_bench [--functions 2000] [--repeat 5]
+
+Compares three ways of loading the same prelude into a new session: running
+every definition (replay), running it from the on-disk program cache, which
+skips lexing and parsing, and restoring a snapshot of a session that already
+ran it. Each is timed --repeat times and the median is reported. The
+restored session is checked against the replayed one on a few calls.
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import ProjectPartA
+
+from benchmarks.memory_bench import generate_script, letters
+
+
+def prelude(function_count):
+    # The memory benchmark's script starts every group of statements with a DEFUN
+    return [line for line in generate_script(function_count * 4) if line.startswith('DEFUN')]
+
+
+def replay(path):
+    session = ProjectPartA.Session()
+    for result, error in session.run_file(path):
+        if error: raise RuntimeError(error.as_string())
+    return session
+
+
+def replay_cached(path):
+    session = ProjectPartA.Session()
+    for result, error in session.run_file(path, cache=True):
+        if error: raise RuntimeError(error.as_string())
+    return session
+
+
+def median_time(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--functions', type=int, default=2000, help='DEFUNs in the prelude')
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'prelude.txt')
+        snapshot_path = os.path.join(directory, 'prelude.snapshot')
+        with open(path, 'w') as file:
+            file.write('\n'.join(prelude(args.functions)) + '\n')
+
+        # Writes the program cache and the snapshot used below
+        replay_cached(path).save_snapshot(snapshot_path)
+
+        timings = [
+            ('replay', median_time(lambda: replay(path), args.repeat)),
+            ('program cache', median_time(lambda: replay_cached(path), args.repeat)),
+            ('snapshot', median_time(lambda: ProjectPartA.Session.load_snapshot(snapshot_path), args.repeat)),
+        ]
+
+        calls = [f"fun{letters(n)}({n}, {n + 1})" for n in range(0, args.functions, max(1, args.functions // 5))]
+        replayed, restored = replay(path), ProjectPartA.Session.load_snapshot(snapshot_path)
+        for call in calls:
+            if replayed.run('<bench>', call) != restored.run('<bench>', call):
+                raise RuntimeError(f"The restored session gives a different result for {call}")
+
+        print(f"{args.functions} functions, {os.path.getsize(path):,} bytes of source, "
+              f"{os.path.getsize(path + ProjectPartA.PROGRAM_CACHE_SUFFIX):,} bytes of program cache, "
+              f"{os.path.getsize(snapshot_path):,} bytes of snapshot")
+        print(f"{'startup':16} {'median':>10} {'speedup':>8}")
+        for name, seconds in timings:
+            print(f"{name:16} {seconds * 1e3:>7.1f} ms {timings[0][1] / seconds:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""Benchmark suite for the lexers, the parser and the execution engines.
+
+Run from the FinalProjectPartA directory:
+
+    python -m benchmarks.suite [--engine E ...] [--json results.json]
+                               [--baseline baseline.json] [--threshold 0.15]
+
+Every case runs a few warmup rounds and then a fixed number of timed
+samples, and reports the median and 10th/90th percentiles of the time per
+run. Results can be written to a JSON file; given a baseline written the
+same way, each case's median is compared against it and the exit status is
+1 if any case is slower by more than the threshold (15% by default).
+Baselines are only comparable on the same machine and Python version.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+
+import ProjectPartA
+
+from benchmarks.memory_bench import count_nodes, generate_script
+
+FUNCTIONS = [
+    "DEFUN factorial(n) : if n == 0 then 1 else n * factorial(n - 1)",
+    "DEFUN fibonacci(n) : if n <= 1 then n else fibonacci(n - 1) + fibonacci(n - 2)",
+]
+
+# (name, source, runs per sample) for every engine
+PROGRAMS = [
+    ('fibonacci', "fibonacci(15)", 1),
+    ('factorial', "factorial(150)", 10),
+    ('lambda', "(lambda f: f(2))(lambda x: x * x + 1)", 200),
+    ('for_loop', "FOR i = 1 TO 20000 DO i * i % 7", 1),
+]
+
+
+class Case:
+    def __init__(self, name, run, number=1, work=None, unit=None):
+        # work / time per run is reported as the throughput in unit
+        self.name = name
+        self.run = run
+        self.number = number
+        self.work = work
+        self.unit = unit
+
+
+def lexer_case(lexer_name, lines):
+    lexer_class = ProjectPartA.LEXERS[lexer_name]
+
+    def run():
+        for line in lines:
+            tokens, error = lexer_class('<bench>', line).make_tokens()
+            if error: raise RuntimeError(error.as_string())
+
+    return Case(f'lex_{lexer_name}', run, work=sum(map(len, lines)) / 1e6, unit='MB/s')
+
+
+def parser_case(lines):
+    token_lists = []
+    for line in lines:
+        tokens, error = ProjectPartA.my_Lexer('<bench>', line).make_tokens()
+        if error: raise RuntimeError(error.as_string())
+        token_lists.append(tokens)
+
+    node_count = 0
+    for tokens in token_lists:
+        node_count += count_nodes(ProjectPartA.Parser(tokens).parse().node, ProjectPartA)
+
+    def run():
+        for tokens in token_lists:
+            result = ProjectPartA.Parser(tokens).parse()
+            if result.error: raise RuntimeError(result.error.as_string())
+
+    return Case('parse', run, work=node_count, unit='nodes/s')
+
+
+def program_case(engine, name, text, number):
+    node, error = ProjectPartA.parse('<bench>', text)
+    if error: raise RuntimeError(error.as_string())
+
+    def run():
+        result, error = ProjectPartA.execute(node, engine)
+        if error: raise RuntimeError(error.as_string())
+
+    return Case(f'{name}[{engine}]', run, number=number)
+
+
+def build_cases(engines, statements):
+    lines = generate_script(statements)
+    cases = [lexer_case(lexer_name, lines) for lexer_name in ProjectPartA.LEXERS]
+    cases.append(parser_case(generate_script(statements // 10)))
+    for engine in engines:
+        for name, program_text, number in PROGRAMS:
+            cases.append(program_case(engine, name, program_text, number))
+    return cases
+
+
+def time_case(case, warmup, repeat):
+    for _ in range(warmup):
+        case.run()
+
+    samples = []
+    gc.collect()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(case.number):
+                case.run()
+            samples.append((time.perf_counter() - start) / case.number)
+    finally:
+        if gc_was_enabled: gc.enable()
+
+    deciles = statistics.quantiles(samples, n=10, method='inclusive')
+    result = {
+        'median': statistics.median(samples),
+        'p10': deciles[0],
+        'p90': deciles[-1],
+        'samples': samples,
+    }
+    if case.work:
+        result['throughput'] = case.work / result['median']
+        result['unit'] = case.unit
+    return result
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print()
+    print(f"{'case':28} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['median'], result['median']
+        change = after / before - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:28} {format_time(before):>12} {format_time(after):>12} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            return f'{seconds * scale:.2f} {unit}'
+    return f'{seconds * 1e9:.0f} ns'
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--engine', action='append', choices=ProjectPartA.ENGINES,
+                            help='engines to run the programs on (default: all)')
+    arg_parser.add_argument('--statements', type=int, default=2000,
+                            help='statements in the generated lexing script')
+    arg_parser.add_argument('--warmup', type=int, default=2)
+    arg_parser.add_argument('--repeat', type=int, default=11)
+    arg_parser.add_argument('--json', help='write the results to this file')
+    arg_parser.add_argument('--baseline', help='compare against results saved with --json')
+    arg_parser.add_argument('--threshold', type=float, default=0.15,
+                            help='slowdown of the median that counts as a regression')
+    args = arg_parser.parse_args()
+
+    # The tree walkers recurse a few frames per call
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10_000))
+
+    # Loop output and memoized results would hide what is being measured.
+    # Functions decide on memoization at their first call, so it stays off.
+    ProjectPartA.set_loop_output(None)
+    ProjectPartA.default_session.memo_cache_size = 0
+    for definition in FUNCTIONS:
+        result, error = ProjectPartA.run('<bench>', definition)
+        if error: raise RuntimeError(error.as_string())
+
+    results = {}
+    print(f"{'case':28} {'median':>12} {'p10':>12} {'p90':>12} {'throughput':>20}")
+    for case in build_cases(args.engine or ProjectPartA.ENGINES, args.statements):
+        result = time_case(case, args.warmup, args.repeat)
+        results[case.name] = result
+        throughput = f"{result['throughput']:,.1f} {result['unit']}" if case.work else ''
+        print(f"{case.name:28} {format_time(result['median']):>12} {format_time(result['p10']):>12}"
+              f" {format_time(result['p90']):>12} {throughput:>20}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) slower than the baseline by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
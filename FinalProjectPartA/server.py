@@ -0,0 +1,221 @@
+"""Evaluation server speaking line-delimited JSON over TCP or a Unix socket.
+
+Run from the FinalProjectPartA directory:
+
+    python server.py [--host 127.0.0.1] [--port 8765 | --unix PATH]
+                     [--workers N] [--timeout 5] [--max-pending N]
+
+Every request is one line holding a JSON object:
+
+    {"id": 1, "code": "fibonacci(20)", "engine": "vm"}
+
+Only "code" is required; "engine", "optimize" and "lexer" work as in
+ProjectPartA.run() and "id" is echoed back. Every request gets one response
+line, in the order the requests were sent:
+
+    {"id": 1, "result": 6765, "error": null}
+
+Each connection has its own Session, so functions it defines are not seen by
+other connections. Evaluations run in a thread pool, never on the event loop.
+At most --max-pending evaluations are queued or running at once; beyond that
+the server stops reading requests until a slot frees up, and clients that
+don't read their responses stop being read from as well. An evaluation that
+takes longer than --timeout gets an error response and is cancelled with
+Session.cancel(), which stops it at its next function call or loop
+iteration; the connection's next request waits for that. Closing the
+connection or the server cancels its evaluations the same way.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import ProjectPartA
+
+# Longest request line accepted, in bytes
+MAX_REQUEST_SIZE = 1 << 20
+
+
+def encode_value(value):
+    if isinstance(value, ProjectPartA.Function):
+        return f"<function {value.name}>"
+    if isinstance(value, ProjectPartA.Builtin):
+        return f"<builtin {value.name}>"
+    return value
+
+
+def evaluate(session, request, stopped):
+    # Runs in a worker thread; everything CPU-bound, including encoding the
+    # result, happens here. stopped is checked once the session counts as
+    # running, so a Session.cancel() made after stopped was set always
+    # reaches the statement.
+    return session.execute(evaluate_request, session, request, stopped)
+
+
+def evaluate_request(session, request, stopped):
+    if stopped.is_set():
+        return error_response(request, "Evaluation cancelled")
+
+    result, error = session.run('<request>', request['code'], engine=request.get('engine', 'interpreter'),
+                                optimize=request.get('optimize', True), lexer=request.get('lexer', 'reference'))
+    try:
+        return json.dumps({'id': request.get('id'), 'result': encode_value(result),
+                           'error': error.as_string().rstrip() if error else None})
+    except ValueError:
+        # Integers beyond sys.get_int_max_str_digits() can't be converted to text
+        return error_response(request, "Result has too many digits to encode")
+
+
+def error_response(request, message):
+    return json.dumps({'id': request.get('id'), 'result': None, 'error': message})
+
+
+def check_request(request):
+    if not isinstance(request, dict):
+        return "Request must be a JSON object"
+    if not isinstance(request.get('code'), str):
+        return "Request needs a 'code' string"
+    if request.get('engine', 'interpreter') not in ProjectPartA.ENGINES:
+        return f"Unknown engine, expected one of {ProjectPartA.ENGINES}"
+    if request.get('lexer', 'reference') not in ProjectPartA.LEXERS:
+        return f"Unknown lexer, expected one of {tuple(ProjectPartA.LEXERS)}"
+    if not isinstance(request.get('optimize', True), bool):
+        return "'optimize' must be true or false"
+    return None
+
+
+class EvaluationServer:
+    def __init__(self, workers=None, timeout=5.0, max_pending=None):
+        # ThreadPoolExecutor's default; the threads share the GIL, so they let
+        # slow requests overlap with quick ones rather than run in parallel
+        self.workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='evaluate')
+        # Evaluations queued or running, including ones that timed out
+        self.slots = asyncio.Semaphore(max_pending or self.workers * 2)
+        self.server = None
+        self.handlers = set()
+
+    async def start(self, host='127.0.0.1', port=8765, unix_path=None):
+        if unix_path:
+            self.server = await asyncio.start_unix_server(self.handle_connection, unix_path, limit=MAX_REQUEST_SIZE)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_REQUEST_SIZE)
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        # Each handler cancels its evaluation on the way out
+        for handler in self.handlers:
+            handler.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def handle_connection(self, reader, writer):
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        session = ProjectPartA.Session()
+        session.set_loop_output(None)
+        # The evaluation still running for this connection after a timeout
+        running = None
+        future = stopped = None
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    writer.write(error_response({}, "Request too long").encode() + b'\n')
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request, message = {}, "Request is not valid JSON"
+                else:
+                    message = check_request(request)
+
+                if message:
+                    response = error_response(request if isinstance(request, dict) else {}, message)
+                else:
+                    stopped = threading.Event()
+                    future = asyncio.ensure_future(self.submit(session, request, running, stopped))
+                    try:
+                        response = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                    except asyncio.TimeoutError:
+                        response = error_response(request, f"Timeout: evaluation took longer than {self.timeout}s")
+                        stop_evaluation(session, stopped)
+                        running = future
+                    except Exception as exception:
+                        response = error_response(request, f"Internal error: {exception!r}")
+                        running = None
+                    else:
+                        running = None
+
+                writer.write(response.encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            # Only close() cancels handlers, and the connection just ends
+            pass
+        finally:
+            if future is not None and not future.done():
+                stop_evaluation(session, stopped)
+                await asyncio.wait([future])
+            writer.close()
+            self.handlers.discard(handler)
+
+    async def submit(self, session, request, running, stopped):
+        if running is not None:
+            # Its response was the timeout error, so only wait for it
+            try:
+                await running
+            except Exception:
+                pass
+        async with self.slots:
+            return await asyncio.wrap_future(self.executor.submit(evaluate, session, request, stopped))
+
+
+def stop_evaluation(session, stopped):
+    # Set first: an evaluation that isn't running yet then never starts
+    stopped.set()
+    session.cancel()
+
+
+async def serve(host, port, unix_path, workers, timeout, max_pending):
+    evaluation_server = EvaluationServer(workers, timeout, max_pending)
+    server = await evaluation_server.start(host, port, unix_path)
+    address = unix_path or ', '.join(str(sock.getsockname()[:2]) for sock in server.sockets)
+    print(f"Serving on {address} with {evaluation_server.workers} workers")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead of TCP')
+    arg_parser.add_argument('--workers', type=int, help='evaluation threads (default: CPU cores + 4, at most 32)')
+    arg_parser.add_argument('--timeout', type=float, default=5.0, help='seconds before a request times out')
+    arg_parser.add_argument('--max-pending', type=int, help='evaluations queued or running at once'
+                                                             ' (default: twice the workers)')
+    args = arg_parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.timeout, args.max_pending))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()